@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Time how long fab takes to start. Run it from the root of a project that
+uses these tools:
+
+    python tools/bench_startup.py [runs] [max ms]
+
+It exits non-zero if the median `fab --list` is slower than max ms, so it
+can guard against startup regressions in a build script.
+"""
+import os
+import subprocess
+import sys
+import time
+
+BENCHMARKS = [
+    ('import tools.fablib', [sys.executable, '-c', 'import tools.fablib']),
+    ('fab --list', ['fab', '--list']),
+    ('fab check_names', ['fab', 'check_names']),
+]
+
+
+def median_ms(command, runs):
+    """
+    Run a command a number of times, returning the median wall time in ms.
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull)
+            times.append((time.time() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main(args):
+    if not os.path.exists('fabfile.py'):
+        print(__doc__)
+        return 65
+
+    runs = int(args[0]) if args else 10
+    max_ms = float(args[1]) if len(args) > 1 else None
+
+    results = {}
+    for name, command in BENCHMARKS:
+        results[name] = median_ms(command, runs)
+        print('%-20s %6.0fms' % (name + ':', results[name]))
+
+    if max_ms is not None and results['fab --list'] > max_ms:
+        print('fab --list took %.0fms, more than %.0fms'
+              % (results['fab --list'], max_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,13 +1,24 @@
 # Chicago Tribune News Applications fabfile
 # Copying encouraged!
 
+import json
 import os
+import re
+import sys
+import threading
+import time
+from getpass import getpass as _getpass
+from pipes import quote as _quote
 
 from fabric.api import *
 from fabric.contrib.console import confirm
-from fabric.contrib.files import exists
+from fabric.contrib.files import exists, is_link
 from fabric.context_managers import cd
 from fabric.decorators import parallel, runs_once
+from fabric.network import join_host_strings as _join_host_strings
+from fabric.network import normalize as _normalize
+from fabric import state
+from fabric.state import connections
 from fabric import colors
 from contextlib import nested
 
@@ -16,12 +27,31 @@ env.use_gunicorn = True
 env.use_nginx = True
 env.use_django_static = True
 env.django_sites = []
-env.gunicorn_workers = 2
+env.gunicorn_workers = 2  # or 'auto' to size by CPUs and memory
 env.celery_workers = 2
 
 SETTINGS_PROVIDERS = ["production", "staging", "vagrant", "aws"]
 BRANCH_PROVIDERS = ["stable", "master", "branch"]
 
+# What clone_db takes from the settings for each side
+CLONE_SETTINGS = ('db_type', 'db_host', 'db_root_user', 'db_root_pass')
+# and how to connect to its admin host
+CLONE_CONNECTION = ('key_filename', 'no_agent')
+
+DUMP_EXTENSIONS = {'bz2': '.sql.bz2', 'zst': '.sql.zst', 'dir': '.pgdump'}
+
+# Where install_requirements and activating a release record what was last
+# installed in the virtualenv
+REQUIREMENTS_STAMP = '%(env_path)s/.requirements.sha1'
+
+# Prints the sha256 of each chunk of a file, for resuming transfers
+REMOTE_CHUNK_SUMS = (
+    "python -c 'import hashlib, sys; f = open(sys.argv[2], \"rb\"); "
+    "[sys.stdout.write(hashlib.sha256(c).hexdigest() + \"\\n\") for c in "
+    "iter(lambda: f.read(int(sys.argv[1])), b\"\")]' %d %s")
+
+_lazy_modules = {}
+
 
 # Local Vagrant target
 def vagrant():
@@ -132,6 +162,14 @@ def setup():
         install_nginx_conf()
 
 
+env.gunicorn_worker_class = 'gevent'
+env.gunicorn_worker_memory = 150  # MB, caps auto workers
+env.gunicorn_max_requests = 1000
+env.gunicorn_max_requests_jitter = None  # needs gunicorn 19.2
+env.gunicorn_preload = False
+env.gunicorn_reload = 'upgrade'  # or 'hup'
+
+
 @parallel
 @roles('app')
 def install_gunicorn():
@@ -157,12 +195,13 @@ def install_gunicorn():
              '/etc/service/%(project_name)s/run' % env)
     elif exists('%(path)s/tools/run_server.sh' % env):
         # install the generic tools run_server.sh script
-        sudo('echo "#!/bin/sh\nexec %(path)s/tools/run_server.sh %(settings)s %(project_name)s %(gunicorn_workers)s" > /etc/service/%(project_name)s/run' % env)
-        sudo('chmod +x /etc/service/%(project_name)s/run' % env)
-        for slug in env.django_sites:
-            with settings(site=slug):
-                sudo('echo "#!/bin/sh\nexec %(path)s/tools/run_server.sh %(settings)s %(project_name)s %(gunicorn_workers)s %(site)s" > /etc/service/%(project_name)s_%(site)s/run' % env)
-                sudo('chmod +x /etc/service/%(project_name)s_%(site)s/run' % env)
+        with settings(gunicorn_environment=_gunicorn_environment()):
+            sudo('echo "#!/bin/sh\nexport %(gunicorn_environment)s\nexec %(path)s/tools/run_server.sh %(settings)s %(project_name)s %(gunicorn_workers)s" > /etc/service/%(project_name)s/run' % env)
+            sudo('chmod +x /etc/service/%(project_name)s/run' % env)
+            for slug in env.django_sites:
+                with settings(site=slug):
+                    sudo('echo "#!/bin/sh\nexport %(gunicorn_environment)s\nexec %(path)s/tools/run_server.sh %(settings)s %(project_name)s %(gunicorn_workers)s %(site)s" > /etc/service/%(project_name)s_%(site)s/run' % env)
+                    sudo('chmod +x /etc/service/%(project_name)s_%(site)s/run' % env)
 
     with settings(hide('warnings'), warn_only=True):
         # make sure the log files are setup properly
@@ -175,35 +214,75 @@ def install_gunicorn():
             sudo('sv start %s_%s' % (env.project_name, slug))
 
 
+def _gunicorn_environment():
+    """
+    The environment variables that pass the gunicorn settings to
+    run_server.sh.
+    """
+    variables = [
+        'GUNICORN_WORKER_CLASS=%(gunicorn_worker_class)s' % env,
+        'GUNICORN_WORKER_MEMORY=%(gunicorn_worker_memory)s' % env,
+        'GUNICORN_MAX_REQUESTS=%(gunicorn_max_requests)s' % env,
+        'GUNICORN_PRELOAD=%s' % str(_to_bool(env.gunicorn_preload)).lower(),
+        'GUNICORN_SERVICES=%d' % len(_gunicorn_services()),
+    ]
+    if env.gunicorn_max_requests_jitter is not None:
+        variables.append(
+            'GUNICORN_MAX_REQUESTS_JITTER=%(gunicorn_max_requests_jitter)s'
+            % env)
+    return ' '.join(variables)
+
+
+env.celery_pool = 'gevent'
+env.celery_autoscale = None  # 'max,min' workers instead of celery_workers
+env.celery_prefetch_multiplier = None
+env.celery_max_tasks_per_child = 100
+# Queues to run separate workers for, with settings that differ from the
+# ones above, e.g. {'images': {'pool': 'prefork', 'autoscale': '4,1'}}
+env.celery_queues = {}
+
+
 @parallel
 @roles('worker')
 def install_celery():
     """
-    Link up and install the runit script for celery
+    Link up and install the runit scripts for celery. With
+    env.celery_queues, each queue also gets a service of its own.
     """
     if env.use_celery:
         with settings(hide('warnings'), warn_only=True):
-            sudo('sv stop %(project_name)s_worker' % env)
-            sudo('rm -Rf /etc/service/%(project_name)s_worker' % env)
-
+            # Stop all the celery runit services and delete them, including
+            # ones for queues that aren't configured any more
+            for name in _celery_service_names():
+                sudo('for s in /etc/service/%s /etc/service/%s_*; do '
+                     '[ -d $s ] && { sv stop $s; rm -Rf $s; }; done; true'
+                     % (name, name))
+
+        services = _celery_services()
         # setup the runit service directories
-        sudo('mkdir /etc/service/%(project_name)s_worker' % env)
-        for slug in env.django_sites:
-            sudo('mkdir /etc/service/%s_%s_worker' % (env.project_name, slug))
+        for service, site, queue in services:
+            sudo('mkdir /etc/service/%s' % service)
 
         if exists('%(path)s/run_%(settings)s_worker.sh' % env):
             # install a custom run_[staging|production]_worker.sh script
-            sudo('ln -s %(path)s/run_%(settings)s_worker.sh '
-                 '/etc/service/%(project_name)s_worker/run' % env)
+            # for each service, runit runs it in the service's directory.
+            # The queue services pass it their CELERY_QUEUE.
+            for service, site, queue in services:
+                if queue:
+                    sudo('echo "#!/bin/sh\nexport CELERY_QUEUE=%s\nexec %s/run_%s_worker.sh" > /etc/service/%s/run' % (
+                        queue, env.path, env.settings, service))
+                    sudo('chmod +x /etc/service/%s/run' % service)
+                else:
+                    sudo('ln -s %s/run_%s_worker.sh /etc/service/%s/run' % (
+                        env.path, env.settings, service))
         elif exists('%(path)s/tools/run_worker.sh' % env):
             # install the generic tools run_worker.sh script
-            sudo('echo "#!/bin/sh\nexec %(path)s/tools/run_worker.sh %(settings)s %(project_name)s %(celery_workers)s" > /etc/service/%(project_name)s_worker/run' % env)
-            sudo('chmod +x /etc/service/%(project_name)s_worker/run' % env)
-
-            for slug in env.django_sites:
-                with settings(site=slug):
-                    sudo('echo "#!/bin/sh\nexec %(path)s/tools/run_worker.sh %(settings)s %(project_name)s %(celery_workers)s %(site)s" > /etc/service/%(project_name)s_%(site)s_worker/run' % env)
-                    sudo('chmod +x /etc/service/%(project_name)s_%(site)s_worker/run' % env)
+            for service, site, queue in services:
+                environment, workers = _celery_environment(queue)
+                sudo('echo "#!/bin/sh\nexport %s\nexec %s/tools/run_worker.sh %s %s %s %s" > /etc/service/%s/run' % (
+                    environment, env.path, env.settings, env.project_name,
+                    workers, site or '', service))
+                sudo('chmod +x /etc/service/%s/run' % service)
 
         with settings(hide('warnings'), warn_only=True):
             # make sure the log files are setup properly
@@ -211,9 +290,54 @@ def install_celery():
             sudo('chmod ug+rw /home/newsapps/logs/%(project_name)s-worker.error.log' % env)
             sudo('chgrp www-data /home/newsapps/logs/%(project_name)s-worker.error.log' % env)
             # start the new servers
-            sudo('sv start %(project_name)s_worker' % env)
-            for slug in env.django_sites:
-                sudo('sv start %s_%s_worker' % (env.project_name, slug))
+            for service, site, queue in services:
+                sudo('sv start %s' % service)
+
+
+def _celery_service_names():
+    """
+    The runit service for celery for the project and each of its sites.
+    """
+    return ['%s_worker' % env.project_name] + [
+        '%s_%s_worker' % (env.project_name, site) for site in env.django_sites]
+
+
+def _celery_services():
+    """
+    The runit services running celery on a worker server, with the site and
+    queue each is for: one for each site, plus one for each queue in
+    env.celery_queues for each site.
+    """
+    services = []
+    for name, site in zip(_celery_service_names(),
+                          [None] + list(env.django_sites)):
+        services.append((name, site, None))
+        for queue in sorted(env.celery_queues):
+            services.append(('%s_%s' % (name, queue), site, queue))
+    return services
+
+
+def _celery_environment(queue=None):
+    """
+    The environment variables run_worker.sh gets for a queue, and how many
+    workers it runs when it doesn't autoscale.
+    """
+    options = {
+        'pool': env.celery_pool,
+        'autoscale': env.celery_autoscale,
+        'prefetch_multiplier': env.celery_prefetch_multiplier,
+        'max_tasks_per_child': env.celery_max_tasks_per_child,
+        'workers': env.celery_workers,
+    }
+    if queue:
+        options.update(env.celery_queues[queue] or {})
+        options['queue'] = queue
+    environment = ' '.join(
+        'CELERY_%s=%s' % (name.upper(), options[name])
+        for name in ('queue', 'pool', 'autoscale', 'prefetch_multiplier',
+                     'max_tasks_per_child')
+        if options.get(name) is not None)
+    return environment, options['workers']
 
 
 @parallel
@@ -229,15 +353,74 @@ def install_nginx_conf():
     sudo('service nginx reload')
 
 
+env.wheel_cache = '$HOME/.cache/fablib-wheels'  # on each server
+
+
 @parallel
-def install_requirements():
+def install_requirements(force=False):
     """
-    Install the required packages with pip.
+    Install the required packages with pip, from wheels cached in
+    env.wheel_cache. Skipped if nothing changed since, unless force=True.
     """
     require('settings', provided_by=SETTINGS_PROVIDERS)
 
-    with load_full_shell(), prefix('workon %(project_name)s' % env):
-        run('pip install -q -r %(path)s/requirements.txt' % env)
+    start = time.time()
+    digest = _requirements_digest(env.path)
+    if not _to_bool(force) and _requirements_installed(digest):
+        print(colors.green("Requirements unchanged, skipped pip (%.1fs)"
+                           % (time.time() - start)))
+        return
+
+    count_wheels = 'ls -1 %(wheel_cache)s | wc -l' % env
+    with _virtualenv():
+        run('mkdir -p %(wheel_cache)s' % env)
+        with hide('running', 'stdout'):
+            cached = int(run(count_wheels))
+        run('pip wheel -q --wheel-dir=%(wheel_cache)s '
+            '--find-links=%(wheel_cache)s -r %(path)s/requirements.txt' % env)
+        with hide('running', 'stdout'):
+            built = int(run(count_wheels)) - cached
+        run('pip install -q --find-links=%(wheel_cache)s '
+            '-r %(path)s/requirements.txt' % env)
+    _record_requirements(digest)
+    print(colors.yellow(
+        "Requirements changed, installed in %.1fs. Built %d new wheels, "
+        "the cache had %d." % (time.time() - start, built, cached)))
+
+
+def _requirements_digest(path):
+    """
+    The sha1 of the requirements.txt in a directory on the server, and of
+    any files it pulls in with -r.
+    """
+    with cd(path), hide('running', 'stdout'):
+        digest = run('cat requirements.txt '
+                     '$(sed -n "s/^-r *//p" requirements.txt) | sha1sum')
+    return digest.split()[0]
+
+
+def _requirements_installed(digest):
+    """
+    Whether the virtualenv was last installed from requirements with this
+    digest, and pip freeze lists the same packages it did afterwards.
+    """
+    with _virtualenv(), hide('running', 'stdout'), settings(warn_only=True):
+        found = run('cat %s && pip freeze 2>/dev/null | sha1sum' % (
+            REQUIREMENTS_STAMP % env))
+    # The stamp's digest and freeze hash, then the freeze hash now
+    parts = found.split()
+    return (found.succeeded and len(parts) == 4
+            and parts[:2] == [digest, parts[2]])
+
+
+def _record_requirements(digest):
+    """
+    Stamp the virtualenv with the digest of the requirements just
+    installed and the hash of pip freeze.
+    """
+    with _virtualenv():
+        run('echo %s $(pip freeze 2>/dev/null | sha1sum | cut -c 1-40) > %s'
+            % (digest, REQUIREMENTS_STAMP % env))
 
 
 @parallel
@@ -260,17 +443,211 @@ def mk_cache_dir():
     Creates the directory that nginx uses for caching
     """
     require('settings', provided_by=SETTINGS_PROVIDERS)
-    sudo('mkdir /mnt/nginx-cache')
-    sudo('chmod ugo+rwx /mnt/nginx-cache')
+    sudo('mkdir %(nginx_cache_path)s && chmod ugo+rwx %(nginx_cache_path)s'
+         % env)
 
 
 # Commands - Deployment
 @runs_once
-def deploy():
+def deploy(warm=None):
+    """
+    Deploy the latest code to every server. warm=True (or
+    env.warm_after_deploy) runs warm_cache afterwards.
+    """
     execute(sync)
     execute(install_requirements)
     execute(reload)
     execute(collectstatic)
+    if _to_bool(env.warm_after_deploy if warm is None else warm):
+        execute(warm_cache)
+
+
+env.deploy_pool_size = 0
+
+
+@runs_once
+def pipelined_deploy(pool_size=None):
+    """
+    Deploy with each server going through all the steps on its own,
+    pool_size (env.deploy_pool_size, 0 for all) servers at a time.
+    """
+    require('settings', provided_by=SETTINGS_PROVIDERS)
+    require('branch', provided_by=BRANCH_PROVIDERS)
+
+    hosts = _deploy_hosts()
+    start = time.time()
+    with settings(pool_size=int(pool_size or env.deploy_pool_size)):
+        results = execute(_pipelined_deploy_host, hosts=hosts)
+    _print_deploy_timings(results, time.time() - start)
+
+    failed = [(host, error) for host, (timings, error) in results.items()
+              if error is not None]
+    for host, error in failed:
+        print(colors.red("%s: %s" % (host, error)))
+    if failed:
+        abort("Deploy failed on %d of %d servers" % (len(failed), len(hosts)))
+
+
+def _deploy_hosts():
+    """
+    Every server that gets the code: env.hosts plus the app and worker roles.
+    """
+    hosts = list(env.hosts)
+    for role in ('app', 'worker'):
+        hosts.extend(h for h in env.roledefs.get(role, []) if h not in hosts)
+    return hosts
+
+
+@parallel
+def _pipelined_deploy_host():
+    """
+    Run the deploy steps this server's roles need, timing each one. Returns
+    the timings and what went wrong, if anything.
+    """
+    phases = [('sync', sync), ('requirements', install_requirements)]
+    if env.host_string in env.roledefs.get('app', []):
+        phases.append(('reload', reload_gunicorn))
+        phases.append(('collectstatic', _collect_static))
+    if env.use_celery and env.host_string in env.roledefs.get('worker', []):
+        phases.append(('reload celery', reload_celery))
+
+    timings = []
+    for name, phase in phases:
+        start = time.time()
+        try:
+            phase()
+        except (Exception, SystemExit) as e:
+            timings.append((name, time.time() - start))
+            return timings, '%s failed: %s' % (name, e)
+        timings.append((name, time.time() - start))
+        print(colors.green("[%s] %s done in %.1fs" % (
+            env.host_string, name, timings[-1][1])))
+    return timings, None
+
+
+def _print_deploy_timings(results, elapsed):
+    """
+    Print how long each deploy step took on each server, and the slowest
+    and average time for each step.
+    """
+    print(colors.blue("--DEPLOY TIMINGS--"))
+    phases = {}
+    for host, (timings, error) in sorted(results.items()):
+        print(colors.white(host) + ': ' + ', '.join(
+            '%s %.1fs' % t for t in timings) + ' (%.1fs)' % sum(
+            seconds for name, seconds in timings))
+        for name, seconds in timings:
+            phases.setdefault(name, []).append(seconds)
+    for name, times in phases.items():
+        print('%s: slowest %.1fs, average %.1fs' % (
+            colors.blue(name), max(times), sum(times) / len(times)))
+    print(colors.green("Deployed in %.1fs" % elapsed))
+
+
+class DeployError(Exception):
+    """
+    Raised instead of exiting when a host fails during a rolling deploy.
+    """
+
+
+env.rolling_batch_size = 1
+env.health_check_path = '/'
+env.health_check_timeout = 60
+
+
+@runs_once
+def rolling_deploy(batch_size=None):
+    """
+    Deploy to the app servers a batch at a time, checking each is healthy
+    before the next batch, and roll back if a batch fails.
+    """
+    require('settings', provided_by=SETTINGS_PROVIDERS)
+    require('branch', provided_by=BRANCH_PROVIDERS)
+
+    batch_size = int(batch_size or env.rolling_batch_size)
+    app_hosts = env.roledefs.get('app', [])
+    other_hosts = [h for h in env.hosts if h not in app_hosts]
+
+    deployed = []
+    for i in range(0, len(app_hosts), batch_size):
+        batch = app_hosts[i:i + batch_size]
+        print(colors.green("Deploying to %s" % ', '.join(batch)))
+        deployed.extend(batch)
+        try:
+            with settings(abort_exception=DeployError):
+                execute(_rolling_deploy_host, hosts=batch)
+        except DeployError as e:
+            print(colors.red("Deploy failed: %s" % e))
+            print(colors.red("Rolling back %s" % ', '.join(deployed)))
+            with settings(branch='rollback'):
+                execute(_rolling_deploy_host, hosts=deployed,
+                        check_health=False)
+            abort("Rolled back after a failed deploy")
+
+    if other_hosts:
+        execute(sync, hosts=other_hosts)
+        execute(install_requirements, hosts=other_hosts)
+    if env.use_celery:
+        execute(reload_celery)
+    execute(collectstatic)
+
+
+@parallel
+def _rolling_deploy_host(check_health=True):
+    """
+    Deploy to one app server, then make sure it's serving.
+    """
+    sync()
+    install_requirements()
+    reload_gunicorn()
+    if check_health:
+        _check_gunicorn_health()
+
+
+def _check_gunicorn_health():
+    """
+    Request env.health_check_path from each gunicorn on this server over its
+    unix socket, until it answers without a server error. Aborts if one
+    hasn't after env.health_check_timeout seconds.
+    """
+    for service in _gunicorn_services():
+        socket_path = '/tmp/%s.sock' % service
+        status = _wait_until_healthy(socket_path)
+        if status is not True:
+            abort("%s on %s isn't healthy (HTTP %s)" % (
+                socket_path, env.host_string, status or 'no answer'))
+        print(colors.green("%s is healthy" % socket_path))
+
+
+def _wait_until_healthy(socket_path):
+    """
+    Request env.health_check_path from a gunicorn socket until it answers
+    without a server error. Returns True, or the last answer if that
+    doesn't happen within env.health_check_timeout seconds.
+    """
+    deadline = time.time() + env.health_check_timeout
+    while True:
+        with settings(hide('everything'), warn_only=True):
+            status = run(
+                'curl -s -o /dev/null -w "%%{http_code}" --max-time 5 '
+                '--unix-socket %s -H "Host: %s" http://localhost%s' % (
+                    socket_path, env.get('site_domain', 'localhost'),
+                    env.health_check_path))
+        code = int(status) if status.strip().isdigit() else 0
+        if status.succeeded and 200 <= code < 500:
+            return True
+        if time.time() > deadline:
+            return status
+        time.sleep(1)
+
+
+def _gunicorn_services():
+    """
+    The runit services running gunicorn on an app server, which also name
+    their sockets and pid files in /tmp.
+    """
+    return [env.project_name] + ['%s_%s' % (env.project_name, site)
+                                 for site in env.django_sites]
 
 
 @parallel
@@ -282,23 +659,236 @@ def sync():
     require('settings', provided_by=SETTINGS_PROVIDERS)
     require('branch', provided_by=BRANCH_PROVIDERS)
 
-    with cd(env.path):
-        if env.branch != 'rollback':
-            # mark our currently deployed revision so we can roll back
-            run('git tag -f rollback')
+    commands = []
+    if env.branch != 'rollback':
+        # mark our currently deployed revision so we can roll back
+        commands.append('git tag -f rollback')
+
+        # fetch new stuff from the server
+        commands.append('git fetch')
+
+    # make sure we're on the correct branch
+    commands.append('git checkout %(branch)s' % env)
+
+    if env.branch != 'rollback':
+        # pull updates
+        commands.append('git pull')
+
+    # pull down all the submodules
+    commands.append('git submodule update --init --recursive')
+
+    on_release = is_link(env.path)
+    checkout = '%s/git' % _releases_path() if on_release else env.path
+    with cd(checkout):
+        _run_all(*commands)
+    if on_release:
+        print(colors.yellow("Switching %s back to the git checkout from a "
+                            "release" % env.host_string))
+        _link_release(checkout)
+
+
+# Commands - Release deployment
+env.releases_keep = 5
+
+
+@runs_once
+def deploy_release():
+    """
+    Build a release tarball with its wheels once on env.build_host, spread it
+    to every server and switch them over to it.
+    """
+    require('settings', provided_by=SETTINGS_PROVIDERS)
+    require('branch', provided_by=BRANCH_PROVIDERS)
+    if env.settings == 'vagrant':
+        abort("Vagrant uses the shared /vagrant folder, use deploy instead")
+
+    hosts = _deploy_hosts()
+    build_host = env.get('build_host') or (
+        env.roledefs.get('admin') or hosts)[0]
+    release, tarball = execute(
+        _build_release, hosts=[build_host])[build_host]
+    try:
+        _distribute_release(release, build_host, tarball, hosts)
+    finally:
+        with settings(host_string=build_host):
+            run('rm -rf %s' % os.path.dirname(tarball))
+    execute(_install_release, release, hosts=hosts)
+
+    execute(_activate_release, release, hosts=hosts)
+    execute(reload)
+    execute(collectstatic)
+    print(colors.green("Deployed release %s" % release))
+
+
+@runs_once
+def activate_release(release):
+    """
+    Switch every server to a release that's already on it, with the
+    packages it was built with, and reload. Use activate_release:git to go
+    back to the git checkout.
+    """
+    require('settings', provided_by=SETTINGS_PROVIDERS)
+    execute(_activate_release, release, hosts=_deploy_hosts())
+    execute(reload)
+
+
+def _releases_path():
+    return env.get('releases_path') or '%(path)s-releases' % env
+
+
+def _build_release():
+    """
+    Check out the branch, build wheels for its requirements and tar them
+    up. Returns the release name and the path of the tarball on the build
+    host, in a directory the caller removes once it's been sent out.
+    """
+    build_dir = run('mktemp -d /tmp/%(project_name)s-build.XXXXXX' % env)
+    code_dir = '%s/code' % build_dir
+    try:
+        run('git clone -q --recursive --branch %s %s %s' % (
+            env.branch, env.repository_url, code_dir))
+        with cd(code_dir):
+            revision = run('git rev-parse HEAD').strip()
+            # collectstatic can't ask git for this once .git is gone
+            run('echo %s > CACHEBUSTER' % revision[:6])
+            run('find . -name .git -prune -exec rm -rf {} +')
+            run('%s/bin/pip wheel -q --wheel-dir=wheelhouse '
+                '-r requirements.txt' % env.env_path)
+
+        release = '%s-%s' % (time.strftime('%Y%m%d%H%M%S'), revision[:6])
+        tarball = '%s/%s.tar.gz' % (build_dir, release)
+        run('tar czf %s -C %s .' % (tarball, code_dir))
+        run('rm -rf %s' % code_dir)
+    except:
+        run('rm -rf %s' % build_dir)
+        raise
+    return release, tarball
+
+
+def _distribute_release(release, build_host, tarball, hosts):
+    """
+    Copy a release tarball from the build host to every server, with each
+    server that has it passing it on to another.
+    """
+    sources = {build_host: tarball}
+    pending = list(hosts)
+    while pending:
+        # Which server each server in this round copies from
+        round_sources = dict(zip(pending, sorted(sources.items())))
+        pending = pending[len(round_sources):]
+        execute(_fetch_release, release, round_sources,
+                hosts=sorted(round_sources))
+        for host in round_sources:
+            sources[host] = '%s/%s.tar.gz' % (_releases_path(), release)
+
+
+@parallel
+def _fetch_release(release, sources):
+    """
+    Copy a release tarball next to the releases on this server, from the
+    server sources says to, through here if this server can't ssh to it.
+    """
+    import shutil
+    import tempfile
+    source, path = sources[env.host_string]
+    destination = '%s/%s.tar.gz' % (_releases_path(), release)
+    run('mkdir -p %s' % _releases_path())
+    if source == env.host_string:
+        run('cp %s %s' % (path, destination))
+        return
+
+    user, host, port = _normalize(source)
+    with settings(hide('warnings'), forward_agent=True, warn_only=True):
+        copied = run('scp -q -o BatchMode=yes -P %s %s@%s:%s %s' % (
+            port, user, host, path, destination))
+    if copied.failed:
+        print(colors.yellow("Couldn't copy the release from %s, sending it "
+                            "through here" % source))
+        local_dir = tempfile.mkdtemp(env.project_name)
+        try:
+            local_path = os.path.join(local_dir, os.path.basename(path))
+            with settings(host_string=source):
+                get(path, local_path)
+            put(local_path, destination)
+        finally:
+            shutil.rmtree(local_dir, True)
+
+
+@parallel
+def _install_release(release):
+    """
+    Unpack a release tarball fetched by _fetch_release next to the other
+    releases. Its packages are installed when it's activated.
+    """
+    release_path = '%s/%s' % (_releases_path(), release)
+    run('mkdir -p %s' % release_path)
+    run('tar xzf %s.tar.gz -C %s && rm %s.tar.gz' % (
+        release_path, release_path, release_path))
+
+
+@parallel
+def _activate_release(release):
+    """
+    Install a release's packages, then point env.path at it in one go and
+    delete all but the last env.releases_keep releases. The first time,
+    the git checkout at env.path becomes the `git` release.
+    """
+    releases_path = _releases_path()
+    release_path = '%s/%s' % (releases_path, release)
+    checkout = exists(env.path) and not is_link(env.path)
+    source_path = env.path if checkout and release == 'git' else release_path
+    if not exists(source_path):
+        abort("There's no release %s on %s" % (release, env.host_string))
+
+    # Packages go in while the old code is still in place, so the code
+    # only switches once they're ready
+    if release == 'git':
+        with settings(path=source_path):
+            install_requirements()
+    else:
+        _install_release_requirements(release_path)
+
+    commands = []
+    if checkout:
+        commands += ['mkdir -p %s' % releases_path,
+                     'mv %s %s/git' % (env.path, releases_path)]
+    _link_release(release_path, commands)
+
+    releases = sorted(r for r in run('ls -1 %s' % releases_path).split()
+                      if r not in ('git', release) and not r.endswith('.gz'))
+    keep_others = max(env.releases_keep - 1, 0)
+    for r in releases[:max(len(releases) - keep_others, 0)]:
+        run('rm -rf %s/%s' % (releases_path, r))
 
-            # fetch new stuff from the server
-            run('git fetch')
 
-        # make sure we're on the correct branch
-        run('git checkout %(branch)s' % env)
+def _install_release_requirements(release_path):
+    """
+    Install a release's wheels into the virtualenv, replacing whatever
+    versions another release or the git checkout put there, so going back
+    to an older release brings back its packages too.
+    """
+    with cd(release_path), hide('running', 'stdout'):
+        digest = run('ls -1 wheelhouse | sha1sum').split()[0]
+    if _requirements_installed(digest):
+        print(colors.green("Packages for %s already installed" % (
+            os.path.basename(release_path))))
+        return
 
-        if env.branch != 'rollback':
-            # pull updates
-            run('git pull')
+    with _virtualenv():
+        run('pip install -q --no-index --force-reinstall '
+            '--find-links=%s/wheelhouse -r %s/requirements.txt' % (
+                release_path, release_path))
+    _record_requirements(digest)
 
-        # pull down all the submodules
-        run('git submodule update --init --recursive')
+
+def _link_release(release_path, before=()):
+    """
+    Point env.path at a release, or the git checkout, in one rename, right
+    after any commands in before.
+    """
+    _run_all(*(list(before) + [
+        'ln -sfn %s %s.next' % (release_path, env.path),
+        'mv -Tf %s.next %s' % (env.path, env.path)]))
 
 
 @runs_once
@@ -336,9 +926,8 @@ def reboot_celery():
     if env.use_celery:
         print(colors.red(
             "FORCING RESTART OF CELERY - You should use reload_celery"))
-        sudo('sv restart %(project_name)s_worker' % env)
-        for site in env.django_sites:
-            sudo('sv restart %s_%s_worker' % (env.project_name, site))
+        for service, site, queue in _celery_services():
+            sudo('sv restart %s' % service)
     else:
         print(colors.red("You must set env.use_celery to True"))
 
@@ -356,17 +945,91 @@ def reload():
 
 @parallel
 @roles('app')
-def reload_gunicorn():
+def reload_gunicorn(mode=None):
     """
-    Reload application code and nginx configuration
+    Reload application code and nginx configuration. mode (or
+    env.gunicorn_reload) is 'upgrade' or 'hup'.
     """
+    mode = mode or env.gunicorn_reload
     print(colors.green("Gracefully reloading gunicorn"))
-    sudo('sv hup %(project_name)s' % env)
-    for site in env.django_sites:
-        sudo('sv hup %s_%s' % (env.project_name, site))
+    for service in _gunicorn_services():
+        if mode == 'upgrade' and exists('/tmp/%s.pid' % service):
+            _upgrade_gunicorn(service)
+        else:
+            sudo('sv hup %s' % service)
     sudo('service nginx reload')
 
 
+def _upgrade_gunicorn(service):
+    """
+    Start a new gunicorn master with USR2 and retire the old one once the new
+    workers have loaded the app, or keep the old one if they don't.
+    """
+    pid_file = '/tmp/%s.pid' % service
+    with settings(hide('everything'), warn_only=True):
+        old = sudo('cat %s' % pid_file).strip()
+        hooked = old.isdigit() and sudo('kill -0 %s && test -e %s' % (
+            old, _gunicorn_booted(old))).succeeded
+    if not hooked:
+        sudo('sv hup %s' % service)
+        return
+    sudo('kill -USR2 %s' % old)
+
+    # A new master whose workers can't load the app exits, taking its
+    # pid file with it
+    new = pid = None
+    deadline = time.time() + env.health_check_timeout
+    while time.time() < deadline:
+        time.sleep(1)
+        with settings(hide('everything'), warn_only=True):
+            pid = _gunicorn_new_master(pid_file, old) or pid
+            if pid and sudo('test -e %s' % _gunicorn_booted(pid)).succeeded:
+                new = pid
+                break
+            if pid and sudo('kill -0 %s' % pid).failed:
+                break
+    if new is None:
+        with settings(hide('everything'), warn_only=True):
+            if pid:
+                sudo('kill -TERM %s' % pid)
+            # Older gunicorns move the old master's pid file aside for
+            # the upgrade and don't put it back
+            sudo('[ -s {0}.oldbin ] && mv {0}.oldbin {0}; rm -f {0}.2'.format(
+                pid_file))
+        abort("The new gunicorn for %s on %s didn't start, the old one is "
+              "still serving" % (service, env.host_string))
+
+    # Once the old master and its workers are gone only the new workers
+    # answer on the socket
+    sudo('kill -QUIT %s' % old)
+    with settings(hide('everything'), warn_only=True):
+        while time.time() < deadline and sudo('kill -0 %s' % old).succeeded:
+            time.sleep(1)
+    status = _wait_until_healthy('/tmp/%s.sock' % service)
+    if status is not True:
+        abort("The new gunicorn for %s on %s isn't healthy (HTTP %s)" % (
+            service, env.host_string, status or 'no answer'))
+    print(colors.green("%s is now gunicorn %s" % (service, new)))
+
+
+def _gunicorn_new_master(pid_file, old):
+    """
+    The pid of the master a USR2 upgrade started, if it has written one:
+    gunicorn writes it to pid_file.2, older versions to pid_file itself.
+    """
+    pid = sudo('cat {0}.2 2>/dev/null || cat {0}'.format(pid_file)).strip()
+    if pid.isdigit() and pid != old:
+        return pid
+
+
+def _gunicorn_booted(pid):
+    """
+    The file gunicorn_hooks.py touches once a worker of a master has
+    loaded the app.
+    """
+    return '/tmp/gunicorn-%s.booted' % pid
+
+
 @parallel
 @roles('worker')
 def reload_celery():
@@ -375,13 +1038,237 @@ def reload_celery():
     """
     if env.use_celery:
         print(colors.green("Gracefully reloading celery"))
-        sudo('sv hup %(project_name)s_worker' % env)
-        for site in env.django_sites:
-            sudo('sv hup %s_%s_worker' % (env.project_name, site))
+        for service, site, queue in _celery_services():
+            sudo('sv hup %s' % service)
     else:
         print(colors.red("You must set env.use_celery to True"))
 
 
+# autoscale_celery raises the most workers an autoscaling queue runs on
+# each server, up to its autoscale_limit, with the backlog in Redis
+env.celery_redis = 'localhost:6379/0'  # host:port/db of the broker
+env.celery_control = None  # command for 'celery control', manage.py's if None
+env.celery_tasks_per_worker = 10
+env.celery_autoscale_limit = 16
+env.celery_autoscale_interval = 30
+env.celery_autoscale_cooldown = 300
+env.celery_autoscale_log = '~/logs/%(project_name)s-autoscale.log'
+# where it keeps each queue's max between runs
+env.celery_autoscale_state = '~/logs/%(project_name)s-autoscale.json'
+
+
+@runs_once
+def autoscale_celery(once=False, local=False):
+    """
+    Scale the autoscaling celery queues' workers with their backlog in Redis.
+    once=True scales once, to run from cron; local=True scales this machine.
+    """
+    import socket
+    require('settings', provided_by=SETTINGS_PROVIDERS)
+    once = _to_bool(once)
+    run_locally = _to_bool(local)
+
+    queues = _celery_scaled_queues()
+    if not queues:
+        abort("None of the celery queues autoscale, set env.celery_autoscale "
+              "or an autoscale for each queue in env.celery_queues")
+    if run_locally:
+        hostnames = [socket.gethostname()]
+    else:
+        with hide('running', 'stdout'):
+            hostnames = sorted(set(execute(
+                _hostname, roles=['worker']).values()))
+    nodes = dict((queue, _celery_nodes(queue, hostnames)) for queue in queues)
+
+    # The most workers each queue may run on a server, and when that last
+    # went up or down
+    scaled = _load_celery_scaling(queues)
+    host_string = None if run_locally else (
+        env.roledefs.get('admin') or env.hosts)[0]
+    print(colors.green("Scaling %s on %d worker servers" % (
+        ', '.join(_celery_queue_name(queue) for queue in sorted(queues)),
+        len(hostnames))))
+
+    try:
+        while True:
+            with settings(host_string=host_string):
+                lengths = _celery_queue_lengths(queues, run_locally)
+                for queue in sorted(queues):
+                    scaled[queue] = _scale_celery_queue(
+                        queue, lengths[queue], queues[queue], scaled[queue],
+                        nodes[queue], run_locally)
+            _save_celery_scaling(scaled)
+            if once:
+                break
+            time.sleep(env.celery_autoscale_interval)
+    except KeyboardInterrupt:
+        print("Stopped scaling celery")
+
+
+def _celery_scaled_queues():
+    """
+    The queues that autoscale, with their autoscale max and min and the
+    most workers autoscale_celery can raise the max to. The default queue
+    is None.
+    """
+    queues = {}
+    for queue in [None] + sorted(env.celery_queues):
+        options = (env.celery_queues.get(queue) if queue else None) or {}
+        autoscale = options.get('autoscale', env.celery_autoscale)
+        if not autoscale:
+            continue
+        high, low = [int(n) for n in str(autoscale).split(',')]
+        limit = int(options.get('autoscale_limit', env.celery_autoscale_limit))
+        queues[queue] = (high, low, max(limit, high))
+    return queues
+
+
+def _load_celery_scaling(queues):
+    """
+    Each queue's max and when it last changed from env.celery_autoscale_state,
+    kept within the queue's limits, or its autoscale max for a new queue.
+    """
+    path = os.path.expanduser(env.celery_autoscale_state % env)
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        saved = {}
+    scaled = {}
+    for queue, (high, low, limit) in queues.items():
+        current, changed = saved.get(_celery_queue_name(queue), (high, 0))
+        scaled[queue] = (min(max(int(current), high), limit), changed)
+    return scaled
+
+
+def _save_celery_scaling(scaled):
+    """
+    Write each queue's max and when it last changed to
+    env.celery_autoscale_state, for the next run to pick up.
+    """
+    path = os.path.expanduser(env.celery_autoscale_state % env)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    saved = dict((_celery_queue_name(queue), value)
+                 for queue, value in scaled.items())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(saved, f)
+    os.rename(path + '.tmp', path)
+
+
+def _celery_queue_name(queue):
+    """
+    The name of a queue in the broker; celery's default is 'celery'.
+    """
+    return queue or 'celery'
+
+
+def _celery_nodes(queue, hostnames):
+    """
+    The celery node names of the workers for a queue on each server, from
+    the --hostname run_worker.sh gives them.
+    """
+    nodes = []
+    for hostname in hostnames:
+        for site in [None] + list(env.django_sites):
+            name = '.'.join(part for part in (
+                site, queue, env.project_name, hostname) if part)
+            nodes.append('celery@%s' % name)
+    return nodes
+
+
+def _hostname():
+    """
+    The name this server gives itself.
+    """
+    return run('hostname').strip()
+
+
+def _celery_queue_lengths(queues, run_locally):
+    """
+    How many tasks are waiting in each queue, from the Redis broker.
+    """
+    address, _, db = env.celery_redis.partition('/')
+    host, _, port = address.partition(':')
+    names = [_celery_queue_name(queue) for queue in sorted(queues)]
+    command = "printf 'LLEN %%s\\n' %s | redis-cli -h %s -p %s -n %s" % (
+        ' '.join(_quote(name) for name in names), host, port or 6379, db or 0)
+    with hide('running', 'stdout'):
+        if run_locally:
+            output = local(command, capture=True)
+        else:
+            output = run(command)
+
+    lengths = output.split()
+    if len(lengths) != len(names) or not all(n.isdigit() for n in lengths):
+        abort("Couldn't read the celery queues from Redis at %s: %s" % (
+            env.celery_redis, output.strip()))
+    return dict(zip(sorted(queues), [int(n) for n in lengths]))
+
+
+def _scale_celery_queue(queue, length, limits, scaled, nodes, run_locally):
+    """
+    Tell a queue's workers how many they may run for its backlog. Returns
+    the new max and when it last changed.
+    """
+    import math
+    high, low, limit = limits
+    current, changed = scaled
+    workers = len(nodes) or 1
+    wanted = int(math.ceil(float(length) / env.celery_tasks_per_worker /
+                           workers))
+    target = min(max(wanted, high), limit)
+
+    now = time.time()
+    if target < current and now - changed < env.celery_autoscale_cooldown:
+        target = current
+    if target != current:
+        _log_scaling("%s: %d waiting for %d workers, max %d -> %d" % (
+            _celery_queue_name(queue), length, workers, current, target))
+        changed = now
+    # A raised max is sent every time, as a worker that restarted since
+    # is back to the max it started with
+    if target != current or target != high:
+        replies = _celery_control('autoscale %d %d' % (target, low), nodes,
+                                  run_locally)
+        if replies < len(nodes):
+            print(colors.yellow("Only %d of %d %s workers answered" % (
+                replies, len(nodes), _celery_queue_name(queue))))
+    return target, changed
+
+
+def _celery_control(command, nodes, run_locally):
+    """
+    Send a remote control command to some celery workers, returning how
+    many of them answered.
+    """
+    control = env.celery_control or (
+        'DJANGO_SETTINGS_MODULE=%s ./manage.py celery control' %
+        env.django_settings_module)
+    command = '%s %s -d %s' % (control, command, ','.join(nodes))
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        if run_locally:
+            output = local(command, capture=True)
+        else:
+            with cd(env.path), _virtualenv():
+                output = run(command)
+    return len(re.findall(r'^-> \S+: OK', output, re.M))
+
+
+def _log_scaling(message):
+    """
+    Print a scaling decision and add it to env.celery_autoscale_log with
+    the time it was made.
+    """
+    line = '%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), message)
+    print(colors.green(line))
+    path = os.path.expanduser(env.celery_autoscale_log % env)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'a') as f:
+        f.write(line + '\n')
+
+
 @roles('admin')
 def syncdb_destroy_database():
     """
@@ -392,7 +1279,7 @@ def syncdb_destroy_database():
     destroy_database()
     create_database()
 
-    with cd(env.path), load_full_shell(), prefix('workon %(project_name)s' % env):
+    with cd(env.path), _virtualenv():
         run('DJANGO_SETTINGS_MODULE=%(django_settings_module)s ./manage.py syncdb --noinput' % env)
 
 
@@ -404,7 +1291,7 @@ def create_database():
     require('settings', provided_by=SETTINGS_PROVIDERS)
 
     if 'db_root_pass' not in env:
-        env.db_root_pass = getpass("Database password: ")
+        env.db_root_pass = _getpass("Database password: ")
 
     if env.db_type == 'postgresql':
         run('echo "CREATE ROLE %(project_name)s WITH PASSWORD \'%(database_password)s\' LOGIN CREATEDB;" | PGPASSWORD=%(db_root_pass)s psql --host=%(db_host)s --username=%(db_root_user)s postgres' % env)
@@ -435,7 +1322,7 @@ def destroy_database():
     require('settings', provided_by=SETTINGS_PROVIDERS)
 
     if not env.db_root_pass:
-        env.db_root_pass = getpass("Database password: ")
+        env.db_root_pass = _getpass("Database password: ")
 
     with settings(warn_only=True):
         if confirm("Are you sure you want to drop "
@@ -471,35 +1358,30 @@ def local_destroy_database():
 def load_data(dump_slug='dump'):
     """
     Loads a sql dump file into the database. Takes an optional parameter
-    to use in the sql dump file name.
+    to use in the sql dump file name. Any of the dump formats dump_db
+    writes will do, and the dump is checked against its checksums first.
     """
     require('settings', provided_by=SETTINGS_PROVIDERS)
 
     env.dump_slug = dump_slug
 
     if not env.db_root_pass:
-        env.db_root_pass = getpass("Database password: ")
+        env.db_root_pass = _getpass("Database password: ")
 
-    if env.db_type == 'postgresql':
-        run("bzcat %(repo_path)s/data/%(dump_slug)s.sql.bz2 |PGPASSWORD=%(db_root_pass)s psql --host=%(db_host)s --username=%(db_root_user)s %(project_name)s" % env)
-    else:
-        run("bzcat %(repo_path)s/data/%(dump_slug)s.sql.bz2 "
-            "|mysql --host=%(db_host)s --user=%(db_root_user)s "
-            "--password=%(db_root_pass)s %(project_name)s" % env)
+    _restore_database('%(repo_path)s/data/%(dump_slug)s' % env, remote=True)
 
 
 def local_load_data(dump_slug='dump'):
     env.dump_slug = dump_slug
 
     if not env.db_root_pass:
-        env.db_root_pass = getpass("Database password: ")
+        env.db_root_pass = _getpass("Database password: ")
 
-    if env.db_type == 'postgresql':
-        local("bzcat data/%(dump_slug)s.sql.bz2 |PGPASSWORD=%(db_root_pass)s psql --host=%(db_host)s --username=%(db_root_user)s %(project_name)s" % env)
-    else:
-        local("bzcat data/%(dump_slug)s.sql.bz2 "
-            "|mysql --host=%(db_host)s --user=%(db_root_user)s "
-            "--password=%(db_root_pass)s %(project_name)s" % env)
+    _restore_database('data/%(dump_slug)s' % env, remote=False)
+
+
+env.dump_format = 'bz2'  # or 'zst', or 'dir' for a parallel pg_dump
+env.dump_jobs = 4
 
 
 @roles('admin')
@@ -517,54 +1399,647 @@ def dump_db(dump_slug='dump'):
     env.dump_slug = dump_slug
 
     if not env.db_root_pass:
-        env.db_root_pass = getpass("Database password: ")
+        env.db_root_pass = _getpass("Database password: ")
 
-    if env.db_type == 'postgresql':
-        run("PGPASSWORD=%(db_root_pass)s pg_dump --host=%(db_host)s --username=%(db_root_user)s %(project_name)s |bzip2 > %(repo_path)s/data/%(dump_slug)s.sql.bz2" % env)
-    else:
-        run("mysqldump --host=%(db_host)s --user=%(db_root_user)s "
-            "--password=%(db_root_pass)s --quick --skip-lock-tables "
-            "%(project_name)s |bzip2 > "
-            "%(repo_path)s/data/%(dump_slug)s.sql.bz2" % env)
+    _dump_database('%(repo_path)s/data/%(dump_slug)s' % env, remote=True)
 
 
 def local_dump_db(dump_slug='dump'):
     env.dump_slug = dump_slug
+    _dump_database('data/%(dump_slug)s' % env, remote=False)
+
+
+def _dump_database(path, remote):
+    """
+    Dump the database to path plus the extension for env.dump_format, on
+    the server or locally, then checksum it.
+    """
+    if env.dump_format not in DUMP_EXTENSIONS:
+        abort("env.dump_format should be one of %s" % ', '.join(
+            DUMP_EXTENSIONS))
+    dump_path = path + DUMP_EXTENSIONS[env.dump_format]
+    tools = _dump_tools(remote)
+
     if env.db_type == 'postgresql':
-        local("PGPASSWORD=%(db_root_pass)s pg_dump --host=%(db_host)s --username=%(db_root_user)s %(project_name)s |bzip2 > data/%(dump_slug)s.sql.bz2" % env)
+        dump = ("PGPASSWORD=%(db_root_pass)s pg_dump --host=%(db_host)s "
+                "--username=%(db_root_user)s" % env)
+    elif env.dump_format == 'dir':
+        abort("Directory dumps only work with PostgreSQL")
+    else:
+        dump = ("mysqldump --host=%(db_host)s --user=%(db_root_user)s "
+                "--password=%(db_root_pass)s --quick --skip-lock-tables" % env)
+
+    if env.dump_format == 'dir':
+        # pg_dump won't write into a directory that's already there
+        command = "rm -rf %s && %s --format=directory --jobs=%d --file=%s %s" % (
+            dump_path, dump, env.dump_jobs, dump_path, env.project_name)
     else:
-        local("mysqldump --host=%(db_host)s --user=%(db_root_user)s "
-            "--password=%(db_root_pass)s --quick --skip-lock-tables "
-            "%(project_name)s |bzip2 > "
-            "data/%(dump_slug)s.sql.bz2" % env)
+        progress = 'pv -f -i 5 |' if 'pv' in tools else ''
+        command = "%s %s |%s %s > %s" % (
+            dump, env.project_name, progress,
+            _compressor(env.dump_format, tools), dump_path)
 
+    start = time.time()
+    _dump_shell(remote, command)
+    _dump_shell(remote, _checksum_command(dump_path, tools))
+    _report_dump_speed("Dumped", dump_path, remote, time.time() - start)
 
-@roles('admin')
-def put_dump(dump_file='dump.sql.bz2'):
+
+def _restore_database(path, remote):
     """
-    Upload a dump file to the chosen deployment target. Takes an optional
-    parameter to use for the file name.
+    Load the dump at path (plus whichever extension it has) into the
+    database, after checking it against its checksums if it has them.
     """
-    require('settings', provided_by=SETTINGS_PROVIDERS)
+    tools = _dump_tools(remote)
+    path_exists = exists if remote else os.path.exists
+    for dump_format in [env.dump_format] + sorted(DUMP_EXTENSIONS):
+        dump_path = path + DUMP_EXTENSIONS.get(dump_format, '')
+        if path_exists(dump_path):
+            break
+    else:
+        abort("There's no dump at %s.*" % path)
+
+    _dump_shell(remote, "if [ -f %s.sha256 ]; then %s; fi" % (
+        dump_path, _checksum_command(dump_path, tools, check=True)))
+
+    load = _load_command(dump_format)
+    if dump_format == 'dir':
+        command = ("PGPASSWORD=%s pg_restore --host=%s --username=%s "
+                   "--jobs=%d --dbname=%s %s" % (
+                       env.db_root_pass, env.db_host, env.db_root_user,
+                       env.dump_jobs, env.project_name, dump_path))
+    elif 'pv' in tools:
+        command = "pv -f -i 5 %s |%s |%s" % (
+            dump_path, _compressor(dump_format, tools, decompress=True), load)
+    else:
+        command = "%s < %s |%s" % (
+            _compressor(dump_format, tools, decompress=True), dump_path, load)
 
-    env.dump_file = dump_file
-    put('data/%(dump_file)s' % env,
-        '%(repo_path)s/data/%(dump_file)s' % env)
-    print('Put %(dump_file)s on server.\n' % env)
+    start = time.time()
+    _dump_shell(remote, command)
+    _report_dump_speed("Loaded", dump_path, remote, time.time() - start)
 
 
-@roles('admin')
-def get_dump(dump_file='dump.sql.bz2'):
+def _load_command(dump_format, db=None, strict=False):
     """
-    Download a dump file from the chosen deployment target. Takes an optional
-    parameter to use for the file name.
+    The command that loads an uncompressed sql dump on stdin, into the
+    database in env or the one described by db. strict=True loads it in
+    one transaction that stops at the first error.
     """
-    require('settings', provided_by=SETTINGS_PROVIDERS)
+    db = db or env
+    if db['db_type'] == 'postgresql':
+        return ("PGPASSWORD=%(db_root_pass)s psql --host=%(db_host)s "
+                "--username=%(db_root_user)s %(project_name)s" % db +
+                (' -v ON_ERROR_STOP=1 --single-transaction' if strict else ''))
+    if dump_format == 'dir':
+        abort("Directory dumps only work with PostgreSQL")
+    return ("mysql --host=%(db_host)s --user=%(db_root_user)s "
+            "--password=%(db_root_pass)s %(project_name)s" % db)
 
-    env.dump_file = dump_file
-    get('%(repo_path)s/data/%(dump_file)s' % env,
-        'data/%(dump_file)s' % env)
-    print('Got %(dump_file)s from the server.\n' % env)
+
+def _dump_shell(remote, command, capture=False):
+    """
+    Run a dump or restore pipeline on the server or locally, failing if
+    any part of the pipeline does.
+    """
+    command = 'set -o pipefail; ' + command
+    if remote:
+        return run(command)
+    return local(command, capture=capture, shell='/bin/bash')
+
+
+def _dump_tools(remote):
+    """
+    Which of the optional tools for dumps are installed where the dump runs.
+    """
+    with hide('everything'):
+        found = _dump_shell(
+            remote, 'for t in pv pbzip2 zstd sha256sum; do '
+            'command -v $t >/dev/null && echo $t; done; true', capture=True)
+    return set(found.split())
+
+
+def _compressor(dump_format, tools, decompress=False):
+    """
+    The command that compresses (or decompresses) a dump format on stdin.
+    """
+    if dump_format == 'zst':
+        return 'zstd -q -T0 -d -c' if decompress else 'zstd -q -T0 -c'
+    if 'pbzip2' in tools:
+        return 'pbzip2 -d -c' if decompress else 'pbzip2 -c'
+    return 'bzcat' if decompress else 'bzip2'
+
+
+def _checksum_command(dump_path, tools, check=False):
+    """
+    The command that writes (or checks) the sha256 of every file in a dump.
+    """
+    sha = 'sha256sum' if 'sha256sum' in tools else 'shasum -a 256'
+    directory, name = os.path.split(dump_path)
+    if check:
+        return 'cd %s && %s -c %s.sha256 > /dev/null' % (
+            directory or '.', sha, name)
+    return 'cd %s && find %s -type f | sort | xargs %s > %s.sha256' % (
+        directory or '.', name, sha, name)
+
+
+def _report_dump_speed(action, dump_path, remote, elapsed):
+    """
+    Print how big a dump is and how fast it was written or loaded.
+    """
+    with hide('everything'):
+        kb = int(_dump_shell(
+            remote, 'du -sk %s | cut -f1' % dump_path, capture=True))
+    elapsed = max(elapsed, 0.001)
+    print(colors.green("%s %s (%.1f MB compressed) in %.1fs, %.2f MB/s" % (
+        action, dump_path, kb / 1024.0, elapsed, kb / 1024.0 / elapsed)))
+
+
+env.transfer_chunk_size = 32 * 1024 * 1024
+env.transfer_workers = 4
+
+
+@roles('admin')
+def put_dump(dump_file='dump.sql.bz2'):
+    """
+    Upload a dump file to the chosen deployment target. Takes an optional
+    parameter to use for the file name. Interrupted uploads resume.
+    """
+    require('settings', provided_by=SETTINGS_PROVIDERS)
+
+    env.dump_file = dump_file
+    _transfer_dump('data/%(dump_file)s' % env,
+                   '%(repo_path)s/data/%(dump_file)s' % env, upload=True)
+    print('Put %(dump_file)s on server.\n' % env)
+
+
+@roles('admin')
+def get_dump(dump_file='dump.sql.bz2'):
+    """
+    Download a dump file from the chosen deployment target. Takes an optional
+    parameter to use for the file name. Like put_dump, it moves the file
+    in chunks and resumes an interrupted download.
+    """
+    require('settings', provided_by=SETTINGS_PROVIDERS)
+
+    env.dump_file = dump_file
+    _transfer_dump('%(repo_path)s/data/%(dump_file)s' % env,
+                   'data/%(dump_file)s' % env, upload=False)
+    print('Got %(dump_file)s from the server.\n' % env)
+
+
+@roles('admin')
+def stream_load_data(dump_file='dump.sql.bz2'):
+    """
+    Load a local dump file into the database on the chosen deployment
+    target over ssh. Takes an optional parameter to use for the file name.
+    """
+    require('settings', provided_by=SETTINGS_PROVIDERS)
+
+    env.dump_file = dump_file
+    dump_path = 'data/%(dump_file)s' % env
+    for dump_format, extension in DUMP_EXTENSIONS.items():
+        if dump_path.endswith(extension):
+            break
+    else:
+        abort("Can't tell what kind of dump %s is" % dump_path)
+    if dump_format == 'dir':
+        abort("Directory dumps can't be streamed, use put_dump and load_data")
+    if not os.path.exists(dump_path):
+        abort("There's no dump at %s" % dump_path)
+
+    if not env.db_root_pass:
+        env.db_root_pass = _getpass("Database password: ")
+
+    local_tools = _dump_tools(remote=False)
+    _dump_shell(False, "if [ -f %s.sha256 ]; then %s; fi" % (
+        dump_path, _checksum_command(dump_path, local_tools, check=True)))
+
+    # psql prints a line for every statement, so throw stdout away rather
+    # than let it fill the channel and stall the upload
+    channel, errors = _open_stream(env.host_string, '%s |%s > /dev/null' % (
+        _compressor(dump_format, _dump_tools(remote=True), decompress=True),
+        _load_command(dump_format)))
+
+    size = os.path.getsize(dump_path)
+    sent = 0
+    start = time.time()
+    with open(dump_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            channel.sendall(chunk)
+            sent += len(chunk)
+            _print_transfer_progress(sent, size, start)
+    channel.shutdown_write()
+    status = channel.recv_exit_status()
+    print('')
+
+    if status != 0:
+        abort("Loading %s failed:\n%s" % (dump_path, ''.join(errors)[-4096:]))
+    elapsed = max(time.time() - start, 0.001)
+    print(colors.green("Loaded %s (%.1f MB compressed) in %.1fs, %.2f MB/s" % (
+        dump_path, size / 1048576.0, elapsed, size / 1048576.0 / elapsed)))
+
+
+@runs_once
+def clone_db(source, target, tables='', exclude='', sample_tables='',
+             sample=10, direct=False):
+    """
+    Copy the database from one environment to another, e.g.
+    clone_db:production,staging. Takes optional tables, exclude,
+    sample_tables, sample and direct parameters.
+    """
+    # tables and exclude are tables to copy only or to copy without rows,
+    # sample_tables ones to copy sample percent of the rows of (nothing may
+    # have foreign keys to those). direct=True has the source host ssh to
+    # the target with your agent instead of relaying through here.
+    if source == target:
+        abort("The source and target have to be different")
+    source_db = _clone_settings(source)
+    target_db = _clone_settings(target)
+    if source_db['db_type'] != target_db['db_type']:
+        abort("Can't clone %s into %s" % (
+            source_db['db_type'], target_db['db_type']))
+    if not confirm("Replace the %s database on %s with a copy of %s's?" % (
+            target, target_db['host_string'], source), default=False):
+        abort("Cancelled")
+
+    with settings(**source_db['connection']):
+        source_tools = _dump_tools(remote=True)
+        tablesample = bool(sample_tables) and _clone_tablesample(source_db)
+    with settings(**target_db['connection']):
+        target_tools = _dump_tools(remote=True)
+    dump_format = 'zst' if 'zstd' in source_tools & target_tools else 'bz2'
+
+    dump = '%s |%s' % (
+        _clone_dump_command(source_db, tables.split(), exclude.split(),
+                            sample_tables.split(), float(sample),
+                            tablesample),
+        _compressor(dump_format, source_tools))
+    load = '%s |%s > /dev/null' % (
+        _compressor(dump_format, target_tools, decompress=True),
+        _load_command(dump_format, target_db, strict=True))
+
+    start = time.time()
+    if _to_bool(direct):
+        moved = _clone_direct(source_db, target_db, dump, load)
+    else:
+        moved = _clone_relay(source_db, target_db, dump, load, start)
+    elapsed = max(time.time() - start, 0.001)
+    print(colors.green(
+        "Cloned %s into %s, %.1f MB compressed in %.1fs, %.2f MB/s" % (
+            source, target, moved / 1048576.0, elapsed,
+            moved / 1048576.0 / elapsed)))
+
+
+def _clone_settings(name):
+    """
+    Run a settings provider (name or name:argument) from scratch and pick
+    out the database and connection settings clone_db needs.
+    """
+    provider, args = name.split(':')[0], name.split(':')[1:]
+    if provider not in state.commands:
+        abort("There are no settings called %s" % provider)
+
+    saved = dict(env)
+    try:
+        for key in CLONE_SETTINGS:
+            env.pop(key, None)
+        env.hosts = []
+        env.roledefs = {}
+        state.commands[provider](*args)
+
+        hosts = env.roledefs.get('admin') or env.hosts
+        if not hosts:
+            abort("%s doesn't have an admin host" % name)
+        if not env.get('db_host'):
+            abort("%s doesn't set env.db_host" % name)
+        if not env.get('db_root_pass'):
+            env.db_root_pass = _getpass("%s database password: " % name)
+        # db_type and db_root_user can be left to the fabfile, as aws does
+        db = dict((key, env.get(key) or saved.get(key))
+                  for key in CLONE_SETTINGS)
+        # The provider's user and keys, not ours
+        db['host_string'] = _join_host_strings(*_normalize(hosts[0]))
+        db['connection'] = dict((key, env.get(key))
+                                for key in CLONE_CONNECTION)
+        db['connection']['host_string'] = db['host_string']
+        db['project_name'] = env.project_name
+    finally:
+        env.clear()
+        env.update(saved)
+    return db
+
+
+def _clone_tablesample(db):
+    """
+    Whether the source database can sample with TABLESAMPLE, which needs
+    PostgreSQL 9.5. Aborts if pg_dump is too old to dump in sections.
+    """
+    if db['db_type'] != 'postgresql':
+        return False
+    with hide('everything'):
+        versions = run(
+            "pg_dump --version; PGPASSWORD=%(db_root_pass)s psql "
+            "--host=%(db_host)s --username=%(db_root_user)s -At "
+            "-c 'SHOW server_version_num' %(project_name)s" % db).split()
+    pg_dump = tuple(int(n) for n in re.findall(r'\d+', versions[-2])[:2])
+    if pg_dump < (9, 2):
+        abort("Sampling tables needs pg_dump 9.2 or later, %s has %s" % (
+            db['host_string'], versions[-2]))
+    return int(versions[-1]) >= 90500
+
+
+def _clone_dump_command(db, tables, exclude, sample_tables, sample,
+                        tablesample=True):
+    """
+    The command that dumps a database for clone_db, with only sample
+    percent of the rows of sample_tables.
+    """
+    if db['db_type'] == 'postgresql':
+        # Clear out what's being replaced first, foreign keys and all. The
+        # load runs in one transaction, so it's all or nothing.
+        if tables:
+            clear = 'DROP TABLE IF EXISTS %s CASCADE;' % ', '.join(tables)
+        else:
+            clear = 'DROP SCHEMA public CASCADE; CREATE SCHEMA public;'
+        steps = ['echo %s' % _quote(clear)]
+        dump = ("PGPASSWORD=%(db_root_pass)s pg_dump --host=%(db_host)s "
+                "--username=%(db_root_user)s" % db)
+        filters = ''.join(' --table=%s' % t for t in tables)
+        filters += ''.join(' --exclude-table-data=%s' % t for t in exclude)
+        if not sample_tables:
+            steps.append('%s%s %s' % (dump, filters, db['project_name']))
+            return '{ %s; }' % ' && '.join(steps)
+
+        # Load the sampled rows before the post-data section adds the
+        # constraints and indexes
+        psql = ("PGPASSWORD=%(db_root_pass)s psql --host=%(db_host)s "
+                "--username=%(db_root_user)s %(project_name)s" % db)
+        steps.append('%s --section=pre-data --section=data%s%s %s' % (
+            dump, filters,
+            ''.join(' --exclude-table-data=%s' % t for t in sample_tables),
+            db['project_name']))
+        for t in sample_tables:
+            # pg_dump empties search_path at the top of the dump, so the
+            # table needs its schema
+            table = t if '.' in t else 'public.%s' % t
+            if tablesample:
+                query = 'SELECT * FROM %s TABLESAMPLE BERNOULLI (%g)' % (
+                    table, sample)
+            else:
+                query = 'SELECT * FROM %s WHERE random() < %g' % (
+                    table, sample / 100.0)
+            steps += [
+                "echo 'COPY %s FROM stdin;'" % table,
+                '%s -c %s' % (psql, _quote('COPY (%s) TO STDOUT' % query)),
+                "echo '\\.'"]
+        steps.append('%s --section=post-data%s %s' % (
+            dump, filters, db['project_name']))
+        return '{ %s; }' % ' && '.join(steps)
+
+    dump = ("mysqldump --host=%(db_host)s --user=%(db_root_user)s "
+            "--password=%(db_root_pass)s --quick --skip-lock-tables" % db)
+    ignore = ''.join(' --ignore-table=%s.%s' % (db['project_name'], t)
+                     for t in exclude + sample_tables)
+    command = '%s%s %s %s' % (
+        dump, ignore, db['project_name'], ' '.join(tables))
+    if exclude and not tables:
+        command = '{ %s && %s --no-data %s %s; }' % (
+            command, dump, db['project_name'], ' '.join(exclude))
+    if sample_tables:
+        command = '{ %s && %s --where=%s %s %s; }' % (
+            command, dump, _quote('RAND() < %g' % (sample / 100.0)),
+            db['project_name'], ' '.join(sample_tables))
+    return command
+
+
+def _clone_relay(source_db, target_db, dump, load, start):
+    """
+    Stream a dump from the source host into the target host through our
+    own ssh connections to them. Returns how many bytes went across.
+    """
+    with settings(**source_db['connection']):
+        source_channel, source_errors = _open_stream(
+            env.host_string, dump)
+    with settings(**target_db['connection']):
+        target_channel, target_errors = _open_stream(
+            env.host_string, load)
+    source_channel.shutdown_write()
+
+    moved = 0
+    while True:
+        data = source_channel.recv(1024 * 1024)
+        if not data:
+            break
+        try:
+            target_channel.sendall(data)
+        except (IOError, EOFError):
+            # The load stopped reading, its stderr says why
+            source_channel.close()
+            target_channel.recv_exit_status()
+            print('')
+            abort("Loading the database failed:\n%s" % (
+                ''.join(target_errors)[-4096:] or 'it exited early'))
+        moved += len(data)
+        _print_transfer_progress(moved, 0, start)
+    target_channel.shutdown_write()
+    print('')
+
+    if source_channel.recv_exit_status() != 0:
+        abort("Dumping the database failed:\n%s" % (
+            ''.join(source_errors)[-4096:]))
+    if target_channel.recv_exit_status() != 0:
+        abort("Loading the database failed:\n%s" % (
+            ''.join(target_errors)[-4096:]))
+    return moved
+
+
+def _clone_direct(source_db, target_db, dump, load):
+    """
+    Have the source host ssh to the target and pipe the dump into it.
+    Returns how many bytes went across.
+    """
+    user, host, port = _normalize(target_db['host_string'])
+    # dd counts the bytes on the way through
+    command = (
+        'stats=$(mktemp); %s | dd bs=1M 2> $stats | ssh -o BatchMode=yes '
+        '-p %s %s@%s %s; status=$?; tail -n1 $stats; rm -f $stats; '
+        'exit $status' % (dump, port, user, host,
+                          _quote('/bin/bash -c %s' % _quote(
+                              'set -o pipefail; ' + load))))
+    with settings(forward_agent=True, **source_db['connection']):
+        with hide('running', 'stdout'):
+            result = _dump_shell(True, command)
+    return int(result.splitlines()[-1].split()[0])
+
+
+def _open_stream(host_string, command):
+    """
+    Start a pipeline on a host over its own ssh channel, so we can write
+    to its stdin or read from its stdout as it runs. Returns the channel
+    and a list that fills with anything the pipeline writes to stderr.
+    """
+    channel = connections[host_string].get_transport().open_session()
+    channel.exec_command('/bin/bash -c %s' % _quote(
+        'set -o pipefail; ' + command))
+
+    errors = []
+
+    def read_errors():
+        while True:
+            data = channel.recv_stderr(65536)
+            if not data:
+                break
+            errors.append(data)
+
+    reader = threading.Thread(target=read_errors)
+    reader.daemon = True
+    reader.start()
+    return channel, errors
+
+
+def _transfer_dump(source, destination, upload):
+    """
+    Copy a dump between here and the server in chunks, several at a time
+    over their own sftp channels, skipping chunks that are already there.
+    Checks the copy chunk by chunk afterwards.
+    """
+    chunk_size = env.transfer_chunk_size
+    if upload:
+        local_path, remote_path = source, destination
+    else:
+        local_path, remote_path = destination, source
+
+    # Directory dumps are lots of smaller files, so fabric can copy those
+    is_dir = (os.path.isdir(source) if upload
+              else run('test -d %s' % source, quiet=True).succeeded)
+    if is_dir:
+        if upload:
+            put(source, os.path.dirname(destination))
+        else:
+            get(source, os.path.dirname(destination) or '.')
+        return
+
+    if upload:
+        if not os.path.exists(local_path):
+            abort("There's no dump at %s" % local_path)
+        size = os.path.getsize(local_path)
+        source_sums = _local_chunk_sums(local_path, chunk_size)
+        destination_sums = _remote_chunk_sums(remote_path, chunk_size)
+        run('touch %s' % remote_path, quiet=True)
+    else:
+        found = run('wc -c < %s' % remote_path, quiet=True)
+        if not found.succeeded:
+            abort("There's no dump at %s" % remote_path)
+        size = int(found)
+        source_sums = _remote_chunk_sums(remote_path, chunk_size)
+        destination_sums = _local_chunk_sums(local_path, chunk_size)
+        open(local_path, 'ab').close()
+
+    todo = [i for i, checksum in enumerate(source_sums)
+            if destination_sums[i:i + 1] != [checksum]]
+    print("Sending %d of %d chunks of %s" % (
+        len(todo), len(source_sums), os.path.basename(local_path)))
+
+    def copy_chunk(i):
+        offset = i * chunk_size
+        length = min(chunk_size, size - offset)
+        sftp = connections[env.host_string].open_sftp()
+        try:
+            if upload:
+                with open(local_path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(length)
+                remote_file = sftp.open(remote_path, 'r+')
+                remote_file.set_pipelined(True)
+                remote_file.seek(offset)
+                remote_file.write(data)
+                remote_file.close()
+            else:
+                remote_file = sftp.open(remote_path, 'r')
+                data = b''.join(remote_file.readv([(offset, length)]))
+                remote_file.close()
+                with open(local_path, 'r+b') as f:
+                    f.seek(offset)
+                    f.write(data)
+        finally:
+            sftp.close()
+        return length
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(env.transfer_workers)
+    total = sum(min(chunk_size, size - i * chunk_size) for i in todo)
+    sent = 0
+    start = time.time()
+    try:
+        for length in pool.imap_unordered(copy_chunk, todo):
+            sent += length
+            _print_transfer_progress(sent, total, start)
+    finally:
+        pool.close()
+        pool.join()
+    print('')
+
+    # Drop anything left over from a bigger file that was there before
+    if upload:
+        run('truncate -s %d %s' % (size, remote_path), quiet=True)
+        copied_sums = _remote_chunk_sums(remote_path, chunk_size)
+    else:
+        with open(local_path, 'r+b') as f:
+            f.truncate(size)
+        copied_sums = _local_chunk_sums(local_path, chunk_size)
+    bad = [i for i, checksum in enumerate(source_sums)
+           if copied_sums[i:i + 1] != [checksum]]
+    if bad or len(copied_sums) != len(source_sums):
+        abort("%s doesn't match after copying, chunks %s differ. Run it again "
+              "to resend them." % (destination, ', '.join(map(str, bad))))
+
+    # Bring the checksum file from dump_db along with the dump
+    checksum_path = source + '.sha256'
+    if upload and os.path.exists(checksum_path):
+        put(checksum_path, destination + '.sha256')
+    elif not upload and exists(checksum_path):
+        get(checksum_path, destination + '.sha256')
+
+    elapsed = max(time.time() - start, 0.001)
+    print(colors.green("Copied %.1f MB of %.1f MB in %.1fs, %.2f MB/s" % (
+        sent / 1048576.0, size / 1048576.0, elapsed,
+        sent / 1048576.0 / elapsed)))
+
+
+def _local_chunk_sums(path, chunk_size):
+    """
+    The sha256 of each chunk of a local file, or none if it isn't there.
+    """
+    import hashlib
+    if not os.path.exists(path):
+        return []
+    sums = []
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sums.append(hashlib.sha256(chunk).hexdigest())
+    return sums
+
+
+def _remote_chunk_sums(path, chunk_size):
+    """
+    The sha256 of each chunk of a file on the server, or none if it isn't
+    there.
+    """
+    found = run(REMOTE_CHUNK_SUMS % (chunk_size, path), quiet=True)
+    return found.split() if found.succeeded else []
+
+
+def _print_transfer_progress(sent, total, start):
+    """
+    Overwrite the current line with how far along a transfer is. Leave
+    total at 0 when it isn't known.
+    """
+    elapsed = max(time.time() - start, 0.001)
+    done = '%5.1f%% ' % (100.0 * sent / total) if total else ''
+    sys.stdout.write('\r%s%8.1f MB %6.2f MB/s' % (
+        done, sent / 1048576.0, sent / 1048576.0 / elapsed))
+    sys.stdout.flush()
 
 
 @roles('admin')
@@ -574,7 +2049,7 @@ def do_migration(migration_script):
     env.migration_script = migration_script
 
     if not env.db_root_pass:
-        env.db_root_pass = getpass("Database password: ")
+        env.db_root_pass = _getpass("Database password: ")
 
     if env.db_type == 'postgresql':
         run("cat %(repo_path)s/migrations/%(migration_script)s.psql |PGPASSWORD=%(db_root_pass)s psql --host=%(db_host)s --username=%(db_root_user)s %(project_name)s" % env)
@@ -597,35 +2072,138 @@ def local_migration(migration_script):
 @roles('admin')
 def manage(command):
     require('settings', provided_by=SETTINGS_PROVIDERS)
-    with cd(env.path), load_full_shell(), prefix('workon %(project_name)s' % env):
+    with cd(env.path), _virtualenv():
         run('DJANGO_SETTINGS_MODULE=%s ./manage.py %s' % (env.django_settings_module, command))
 
 
-@parallel
-@roles('app')
+@runs_once
 def collectstatic():
+    """
+    Collect static files on the first app server and copy what changed
+    from there to the rest.
+    """
     require('settings', provided_by=SETTINGS_PROVIDERS)
-    with cd(env.path), load_full_shell(), prefix('workon %(project_name)s' % env):
-        run('git rev-parse HEAD |cut -c 1-6 > CACHEBUSTER')
-        if env.use_django_static and hasattr(env, 'django_settings_module'):
-            with settings(warn_only=True):
-                run('mkdir static')
-            run('DJANGO_SETTINGS_MODULE=%s ./manage.py collectstatic -c --noinput' % env.django_settings_module)
+
+    hosts = env.roledefs.get('app') or env.hosts
+    start = time.time()
+    results = execute(_collect_static, hosts=hosts[:1])
+    if len(hosts) > 1:
+        results.update(execute(_pull_static, hosts[0], hosts=hosts[1:]))
+
+    print("Static files on %d servers in %.1fs" % (
+        len(results), time.time() - start))
+    for host in hosts:
+        elapsed, written, deleted = results[host]
+        print(colors.green("  %-30s %5.1fs, %d files written, %d removed" % (
+            host, elapsed, written, deleted)))
+
+
+def _collect_static():
+    """
+    Write CACHEBUSTER and bring static/ up to date on this server. Returns
+    how long it took and how many files were written and removed.
+    """
+    start = time.time()
+    _write_cachebuster()
+    if not (env.use_django_static and hasattr(env, 'django_settings_module')):
+        return time.time() - start, 0, 0
+
+    # Collecting symlinks into a scratch directory costs next to nothing.
+    # rsync then writes only the files whose contents changed, since a fresh
+    # collect gives every file a new mtime, and deletes the ones that are
+    # gone. The settings module in between just
+    # points STATIC_ROOT at the scratch directory.
+    with cd(env.path), _virtualenv():
+        try:
+            _run_all(
+                "printf '%%s\\n' %s %s > fablib_static_settings.py" % (
+                    _quote('from %s import *' % env.django_settings_module),
+                    _quote('STATIC_ROOT = %r' % (
+                        '%(path)s/static.build' % env))),
+                'rm -rf static.build',
+                'mkdir -p static',
+                'DJANGO_SETTINGS_MODULE=fablib_static_settings ./manage.py '
+                'collectstatic --noinput --link')
+            with hide('stdout'):
+                changes = run('rsync -a --copy-links --checksum --delete '
+                              '--itemize-changes static.build/ static/')
+        finally:
+            run('rm -rf static.build fablib_static_settings.py*')
+    return (time.time() - start,) + _count_rsync_changes(changes)
+
+
+@parallel
+def _pull_static(build_host):
+    """
+    Copy what changed in static/ from build_host to this server with rsync,
+    collecting here instead if this server can't reach it. Returns how long
+    it took and how many files were written and removed.
+    """
+    if not (env.use_django_static and hasattr(env, 'django_settings_module')):
+        return _collect_static()
+
+    start = time.time()
+    _write_cachebuster()
+    user, host, port = _normalize(build_host)
+    with cd(env.path), settings(hide('stdout'), forward_agent=True,
+                                warn_only=True):
+        changes = run(
+            'mkdir -p static && rsync -a --checksum --delete '
+            '--itemize-changes -e "ssh -o BatchMode=yes -p %s" '
+            '%s@%s:%s/static/ static/' % (port, user, host, env.path))
+    if changes.failed:
+        print(colors.yellow("Couldn't copy static files from %s, "
+                            "collecting them here" % build_host))
+        return _collect_static()
+    return (time.time() - start,) + _count_rsync_changes(changes)
+
+
+def _write_cachebuster():
+    """
+    Write the short git hash to CACHEBUSTER, for checkouts that have one.
+    Release deploys write CACHEBUSTER when they're built.
+    """
+    with cd(env.path):
+        run('if [ -d .git ]; then '
+            'git rev-parse HEAD |cut -c 1-6 > CACHEBUSTER; fi')
+
+
+def _count_rsync_changes(changes):
+    """
+    How many files rsync --itemize-changes says it wrote and deleted.
+    """
+    lines = changes.splitlines()
+    written = len([l for l in lines if l[:2] in ('>f', '<f', 'cf')])
+    deleted = len([l for l in lines if l.startswith('*deleting')])
+    return written, deleted
 
 
 # Commands - Cache
+env.purge_concurrency = 8
+env.purge_batch_size = 100
+env.varnish_ban_header = 'X-Ban-Url'
+
+
 @roles('admin')
-def clear_url(url):
+def clear_url(*urls, **kwargs):
     """
-    Takes a partial url ('/story/junk-n-stuff'), and purges it from the
-    Varnish cache.
+    Takes partial urls ('/story/junk-n-stuff'), and purges them from the
+    Varnish cache. Urls with * are globs and ones starting with ~ regexes.
     """
     require('settings', provided_by=SETTINGS_PROVIDERS)
 
+    urls = list(urls)
+    if kwargs.get('file'):
+        with open(kwargs['file']) as f:
+            urls.extend(line.split('#')[0] for line in f)
+    paths, bans = _purge_targets(urls)
+    if not paths and not bans:
+        abort("There aren't any urls to purge")
+
     if confirm("Are you sure? This can bring the servers to their knees..."):
-        for server in env.cache_servers:
-            run('curl -s -I -X PURGE -H "Host: %s" http://%s%s'
-                % (env.site_domain, server, url))
+        start = time.time()
+        results = _purge(paths, bans, _to_bool(kwargs.get('local', False)))
+        _print_purge_report(results, paths, bans, time.time() - start)
 
 
 @roles('admin')
@@ -641,17 +2219,410 @@ def clear_cache():
                 % (env.site_domain, server))
 
 
+env.nginx_cache_path = '/mnt/nginx-cache'
+env.nginx_cache_levels = '1:2'
+env.nginx_cache_key = '$scheme$host$request_uri'
+env.nginx_proxy_host = None
+env.nginx_wipe_batch_size = 500
+env.nginx_wipe_pause = 0.2
+
+
 @roles('app')
-def clear_nginx_cache():
+def clear_nginx_cache(*urls, **kwargs):
     """
-    Connects to all the app servers and deletes the cache for this site
+    Connects to all the app servers and deletes the cache for this site, or
+    just the pages for the partial urls given (with * for a prefix).
     """
     require('settings', provided_by=SETTINGS_PROVIDERS)
 
-    if confirm("Are you sure? This can bring the servers to their knees..."):
-        sudo('rm -Rf /mnt/nginx-cache/%(project_name)s/*' % env)
-        for site in env.django_sites:
-            sudo('rm -Rf /mnt/nginx-cache/%s_%s/*' % (env.project_name, site))
+    directories = ' '.join(_nginx_cache_dirs())
+    if not urls:
+        if confirm("Are you sure? This can bring the servers to their knees..."):
+            with hide('stdout'):
+                deleted = sudo(
+                    "find %s -type f -print0 2>/dev/null | xargs -0 -r -n %d "
+                    "sh -c 'ionice -c3 rm -f \"$@\"; echo $#; sleep %s' rm | "
+                    "awk '{ n += $1 } END { print n + 0 }'" % (
+                        directories, env.nginx_wipe_batch_size,
+                        env.nginx_wipe_pause))
+            print(colors.green("Deleted %s cached files" % deleted))
+        return
+
+    host = kwargs.get('host') or env.site_domain
+    proxy_host = None
+    if '$proxy_host' in env.nginx_cache_key:
+        proxy_host = _nginx_proxy_host()
+    paths = [url if url.startswith('/') else '/' + url for url in urls]
+    files = set()
+    prefixes = []
+    for path in paths:
+        if path.endswith('*'):
+            prefixes.append(path[:-1])
+            continue
+        for scheme in ('http', 'https'):
+            cache_file = _nginx_cache_file(
+                _nginx_cache_key(scheme, host, path, proxy_host))
+            files.update(os.path.join(d, cache_file)
+                         for d in _nginx_cache_dirs())
+
+    commands = []
+    if files:
+        commands.append('rm -fv %s' % ' '.join(sorted(files)))
+    if prefixes:
+        # Each cache file starts with a header that has a "KEY: ..." line
+        keys = '|'.join(
+            re.sub(r'([.+?*^$()\[\]{}|\\])', r'\\\1',
+                   _nginx_cache_key(scheme, host, prefix, proxy_host))
+            for prefix in prefixes for scheme in ('http', 'https'))
+        commands.append(
+            "find %s -type f -print0 2>/dev/null | xargs -0 -r grep -l -a "
+            "-m1 -E %s | xargs -r rm -fv" % (
+                directories, _quote('^KEY: (%s)' % keys)))
+    with hide('stdout'):
+        deleted = sudo('{ %s; } | wc -l' % '; '.join(commands))
+    print(colors.green("Deleted %s cached files" % deleted.strip()))
+
+
+def _purge_targets(urls):
+    """
+    Split urls into paths to purge and regular expressions to ban,
+    dropping blanks and duplicates.
+    """
+    paths = []
+    bans = []
+    for url in urls:
+        url = url.strip()
+        if not url:
+            continue
+        if url.startswith('~'):
+            target, pattern = bans, url[1:]
+        elif '*' in url:
+            glob = re.sub(r'([.+?^$()\[\]{}|\\])', r'\\\1',
+                          url if url.startswith('/') else '/' + url)
+            target, pattern = bans, '^%s$' % glob.replace('*', '.*')
+        else:
+            target, pattern = paths, url if url.startswith('/') else '/' + url
+        if pattern not in target:
+            target.append(pattern)
+    return paths, bans
+
+
+def _purge(paths, bans, run_locally=False):
+    """
+    Purge paths and ban patterns on every cache server in one go. Returns
+    a dict of the status code for each (server, path or pattern); 000
+    means the server couldn't be reached.
+    """
+    host = _quote('Host: %s' % env.site_domain)
+    labels = {}
+    urls = []
+    for server in env.cache_servers:
+        for path in paths:
+            url = 'http://%s%s' % (server, path)
+            labels[url] = (server, path)
+            urls.append(url)
+
+    # curl keeps its connection open across the urls in one invocation,
+    # so each batch costs one connection per server. -o only applies to
+    # the url after it, so every url gets its own.
+    commands = []
+    if urls:
+        commands.append(
+            "printf '%%s\\0' %s | xargs -0 -n %d -P %d curl -s "
+            "-X PURGE -H %s -w '%%{http_code} %%{url_effective}\\n' &" % (
+                ' '.join('-o /dev/null %s' % _quote(url) for url in urls),
+                3 * env.purge_batch_size, env.purge_concurrency, host))
+    for server in env.cache_servers:
+        for pattern in bans:
+            label = 'http://%s/ %s' % (server, pattern)
+            labels[label] = (server, pattern)
+            commands.append(
+                "echo \"$(curl -s -o /dev/null -X BAN -H %s -H %s "
+                "-w '%%{http_code}' http://%s/) \"%s &" % (
+                    host, _quote('%s: %s' % (env.varnish_ban_header, pattern)),
+                    server, _quote(label)))
+    command = '\n'.join(commands + ['wait; true'])
+
+    with hide('running', 'stdout'):
+        if run_locally:
+            output = local(command, capture=True, shell='/bin/bash')
+        else:
+            output = run(command)
+
+    results = dict.fromkeys(labels.values(), '000')
+    for line in output.splitlines():
+        code, _, label = line.strip().partition(' ')
+        if label in labels:
+            results[labels[label]] = code
+    return results
+
+
+def _print_purge_report(results, paths, bans, elapsed):
+    """
+    Print how each cache server did with each purge and ban.
+    """
+    def ok(code):
+        # Varnish answers 404 for a purge of something it hasn't cached
+        return code.startswith('2') or code == '404'
+
+    print("Sent %d purges and %d bans to %d cache servers in %.1fs" % (
+        len(paths), len(bans), len(env.cache_servers), elapsed))
+    for server in env.cache_servers:
+        codes = [results[(server, t)] for t in paths + bans]
+        failed = len([code for code in codes if not ok(code)])
+        color = colors.red if failed else colors.green
+        print(color("  %-30s %d ok, %d failed" % (
+            server, len(codes) - failed, failed)))
+    for target in paths + bans:
+        codes = [results[(server, target)] for server in env.cache_servers]
+        color = colors.green if all(ok(c) for c in codes) else colors.red
+        print(color("  %s  %s" % (' '.join(codes), target)))
+
+
+def _nginx_cache_dirs():
+    """
+    The nginx cache directories for the project and each of its sites.
+    """
+    return ['%s/%s' % (env.nginx_cache_path, name) for name in
+            [env.project_name] + ['%s_%s' % (env.project_name, site)
+                                  for site in env.django_sites]]
+
+
+def _nginx_proxy_host():
+    """
+    What nginx has in $proxy_host: the host of the proxy_pass url, with
+    its port if that isn't the default, or localhost for a unix socket.
+    """
+    if env.nginx_proxy_host:
+        return env.nginx_proxy_host
+    with hide('stdout'):
+        config = sudo("grep -h proxy_pass "
+                      "%(path)s/http/%(settings)s-nginx.conf || true" % env)
+    config = re.sub(r'#.*', '', config)
+    upstreams = set(re.findall(r'proxy_pass\s+(\w+)://([^/;\s]+)', config))
+    if len(upstreams) != 1 or '$' in list(upstreams)[0][1]:
+        abort("Couldn't tell the proxy_pass upstream from the nginx config, "
+              "set env.nginx_proxy_host")
+    scheme, netloc = upstreams.pop()
+    if netloc.startswith('unix:'):
+        return 'localhost'
+    default_port = ':443' if scheme == 'https' else ':80'
+    if netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    return netloc
+
+
+def _nginx_cache_key(scheme, host, request_uri, proxy_host=None):
+    """
+    Fill in env.nginx_cache_key, nginx's proxy_cache_key, for a request.
+    """
+    values = {
+        'scheme': scheme,
+        'host': host,
+        'http_host': host,
+        'request_uri': request_uri,
+        'uri': request_uri.split('?')[0],
+        'args': request_uri.partition('?')[2],
+        'is_args': '?' if '?' in request_uri else '',
+    }
+    if proxy_host:
+        values['proxy_host'] = proxy_host
+
+    def value(match):
+        if match.group(1) not in values:
+            abort("clear_nginx_cache doesn't know about $%s in "
+                  "env.nginx_cache_key" % match.group(1))
+        return values[match.group(1)]
+
+    return re.sub(r'\$(\w+)', value, env.nginx_cache_key)
+
+
+def _nginx_cache_file(key):
+    """
+    Where nginx keeps the cache file for a key, relative to the cache
+    directory: the md5 of the key, under a directory for each of the
+    levels taken from the end of it.
+    """
+    import hashlib
+    digest = hashlib.md5(key).hexdigest()
+    directories = []
+    end = len(digest)
+    for level in env.nginx_cache_levels.split(':'):
+        directories.append(digest[end - int(level):end])
+        end -= int(level)
+    return os.path.join(*(directories + [digest]))
+
+
+env.warm_concurrency = 4
+env.warm_top_urls = 200
+env.warm_access_log = '~/logs/%(project_name)s.access.log'
+env.warm_after_deploy = False
+
+
+@runs_once
+def warm_cache(*urls, **kwargs):
+    """
+    Request the given urls, a file= or sitemap= of them, or the most
+    requested pages in the access log, from each app server.
+    """
+    require('settings', provided_by=SETTINGS_PROVIDERS)
+
+    paths = _warm_paths(urls, kwargs)
+    if not paths:
+        abort("There aren't any urls to warm up")
+
+    start = time.time()
+    if kwargs.get('through') == 'cache':
+        admin = (env.roledefs.get('admin') or env.hosts)[:1]
+        if not admin:
+            abort("There isn't an admin host to warm the caches from")
+        results = execute(_warm_host, paths, None, hosts=admin)
+    else:
+        site = kwargs.get('site')
+        socket_path = '/tmp/%s%s.sock' % (
+            env.project_name, '_%s' % site if site else '')
+        results = execute(_warm_host, paths, socket_path, roles=['app'])
+    _print_warm_report(results, len(paths), time.time() - start)
+
+
+def _warm_paths(urls, kwargs):
+    """
+    The paths warm_cache should request, from its arguments or the access
+    log.
+    """
+    paths = list(urls)
+    if kwargs.get('file'):
+        with open(kwargs['file']) as f:
+            paths.extend(line.split('#')[0] for line in f)
+
+    if kwargs.get('sitemap'):
+        with settings(hide('everything'), host_string=_warm_app_host()):
+            paths.extend(_sitemap_paths(kwargs['sitemap']))
+
+    if not paths:
+        log = env.warm_access_log % env
+        with settings(hide('everything'), host_string=_warm_app_host()):
+            # The request is fields 6-8 and the status field 9 in nginx's
+            # combined log format
+            top = run(
+                "awk '$6 == \"\\\"GET\" && $9 == 200 { print $7 }' %s | "
+                "sort | uniq -c | sort -rn | head -n %d | awk '{ print $2 }'"
+                % (log, env.warm_top_urls))
+        paths = top.split()
+
+    seen = set()
+    unique = []
+    for path in paths:
+        path = path.strip()
+        if path and not path.startswith('/'):
+            path = '/' + path
+        if path and path not in seen:
+            seen.add(path)
+            unique.append(path)
+    return unique
+
+
+def _warm_app_host():
+    """
+    The app server to read sitemaps and the access log on.
+    """
+    hosts = env.roledefs.get('app') or env.hosts
+    if not hosts:
+        abort("There isn't an app host to find urls to warm up on")
+    return hosts[0]
+
+
+def _sitemap_paths(sitemap, follow=True):
+    """
+    The paths of the pages in a sitemap, fetched from this server's
+    gunicorn when sitemap is a path. Follows a sitemap index one level
+    down.
+    """
+    if sitemap.startswith('/'):
+        xml = run('curl -s --unix-socket /tmp/%s.sock -H %s http://localhost%s'
+                  % (env.project_name, _quote('Host: %s' % env.site_domain),
+                     _quote(sitemap)))
+    else:
+        xml = run('curl -s -L %s' % _quote(sitemap))
+
+    paths = []
+    for loc in re.findall(r'<loc>\s*(.*?)\s*</loc>', xml):
+        loc = loc.replace('&amp;', '&')
+        path = re.sub(r'^[a-z]+://[^/]+', '', loc) or '/'
+        if follow and '<sitemapindex' in xml:
+            paths.extend(_sitemap_paths(
+                path if sitemap.startswith('/') else loc, False))
+        else:
+            paths.append(path)
+    return paths
+
+
+@parallel
+def _warm_host(paths, socket_path):
+    """
+    Request paths from a gunicorn socket on this server, or from each cache
+    server when socket_path is None. Returns the status and seconds each
+    request took, for each of them.
+    """
+    if socket_path:
+        targets = [(socket_path, 'http://localhost', '--unix-socket %s ' %
+                    socket_path)]
+    else:
+        targets = [(server, 'http://%s' % server, '')
+                   for server in env.cache_servers]
+
+    urls = {}
+    for name, base, option in targets:
+        for path in paths:
+            urls[base + path] = name
+    commands = [
+        "printf '%%s\\0' %s | xargs -0 -n 30 -P %d curl -s --max-time 30 "
+        "%s-H %s -w '%%{http_code} %%{time_total} %%{url_effective}\\n'" % (
+            ' '.join('-o /dev/null %s' % _quote(base + path) for path in paths),
+            env.warm_concurrency, option,
+            _quote('Host: %s' % env.site_domain))
+        for name, base, option in targets]
+    with hide('running', 'stdout'):
+        output = run('; '.join(commands + ['true']))
+
+    results = dict((name, []) for name, base, option in targets)
+    for line in output.splitlines():
+        parts = line.strip().split(' ', 2)
+        if len(parts) == 3 and parts[2] in urls:
+            results[urls[parts[2]]].append((parts[0], float(parts[1])))
+    return results
+
+
+def _print_warm_report(results, count, elapsed):
+    """
+    Print latency percentiles for each server warm_cache requested pages
+    from.
+    """
+    print("Requested %d pages in %.1fs" % (count, elapsed))
+    for host, targets in sorted(results.items()):
+        for target, requests in sorted(targets.items()):
+            times = sorted(seconds * 1000 for code, seconds in requests)
+            failed = len([code for code, seconds in requests
+                          if not code.startswith(('2', '3'))])
+            failed += count - len(requests)
+            color = colors.red if failed else colors.green
+            print(color(
+                "  %s %s: %d ok, %d failed, p50 %.0fms, p90 %.0fms, "
+                "p99 %.0fms, max %.0fms" % (
+                    host, target, count - failed, failed,
+                    _percentile(times, 50), _percentile(times, 90),
+                    _percentile(times, 99), times[-1] if times else 0)))
+
+
+def _percentile(values, percent):
+    """
+    The nearest-rank percentile of a sorted list.
+    """
+    import math
+    if not values:
+        return 0
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
 
 
 @roles('admin')
@@ -710,15 +2681,16 @@ def shiva_the_destroyer():
         sudo('sv stop %(project_name)s' % env)
         sudo('rm -Rf /etc/service/%(project_name)s' % env)
 
-        # remove runit worker service
+        # remove runit worker services
         if env.use_celery:
-            sudo('sv stop %(project_name)s_worker' % env)
-            sudo('rm -Rf /etc/service/%(project_name)s_worker' % env)
+            for service, site, queue in _celery_services():
+                sudo('sv stop %s' % service)
+                sudo('rm -Rf /etc/service/%s' % service)
 
         with load_full_shell():
             run('rmvirtualenv %(project_name)s' % env)
 
-        run('rm -Rf %(path)s' % env)
+        run('rm -Rf %s %s' % (env.path, _releases_path()))
 
 
 # Other utilities
@@ -730,6 +2702,74 @@ def load_full_shell():
     return prefix('source /etc/bash_completion')
 
 
+def _virtualenv():
+    """
+    Activates the project's virtualenv by its path, without loading
+    virtualenvwrapper the way load_full_shell and 'workon' do.
+    """
+    return prefix('source %(env_path)s/bin/activate' % env)
+
+
+def _run_all(*commands):
+    """
+    Run several commands in one remote shell instead of one round trip
+    each, stopping at the first that fails.
+    """
+    return run(' && '.join(commands))
+
+
+def _cachebuster():
+    """
+    The CACHEBUSTER the servers put in their asset urls, read from the
+    admin server since that's what the pages they serve point at.
+    """
+    host = env.host_string or (env.roledefs.get('admin') or
+                               env.roledefs.get('app') or env.hosts or
+                               [None])[0]
+    if not host:
+        abort("There isn't a server to read CACHEBUSTER from")
+    with settings(hide('everything'), warn_only=True, host_string=host):
+        cachebuster = run('cat %(path)s/CACHEBUSTER' % env)
+    if cachebuster.failed or not re.match(r'^[\w-]+$', cachebuster.strip()):
+        abort("There's no CACHEBUSTER in %s on %s, deploy the code first" % (
+            env.path, host))
+    return cachebuster.strip()
+
+
+def _lazy_import(name, required=True):
+    """
+    Import a module the first time a task needs it, instead of every time
+    fab loads the fabfile. Aborts if a required module isn't installed,
+    returns None for a missing optional one.
+    """
+    import importlib
+    if name not in _lazy_modules:
+        try:
+            _lazy_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _lazy_modules[name] = None
+    if _lazy_modules[name] is None and required:
+        abort("You must install %s!" % name.split('.')[0])
+    return _lazy_modules[name]
+
+
+def _import_for_threads(*names):
+    """
+    Import required modules before a thread pool needs them. _lazy_import
+    aborts with SystemExit, which python 2's thread pools don't pass on,
+    so an abort in one of their threads would hang fab instead.
+    """
+    for name in names:
+        _lazy_import(name)
+
+
+def _to_bool(value):
+    """
+    Fab passes task arguments as strings, turn one into a boolean.
+    """
+    return str(value).lower() in ('1', 'true', 'yes', 'y', 'on')
+
+
 @runs_once
 def check_names():
     """
@@ -761,148 +2801,886 @@ def start_app():
         sudo('sv start %s_%s' % (env.project_name, site))
 
 
-try:
-    import boto
-    from boto.s3.connection import S3Connection
-    from boto.s3.key import Key
-    import tempfile
-    import gzip
-    import shutil
+# AWS
+# boto is only imported when a task needs it, see _lazy_import
+S3_MANIFEST_VERSION = 1
+S3_CHUNK_SIZE = 65536
+
+_s3_local = threading.local()
+
+env.aws_regions = None  # or a list, boto's default region if None
+env.aws_inventory_ttl = 300
+env.aws_inventory_cache = os.path.expanduser('~/.fablib-inventory.json')
+
+
+def aws(*clusters, **kwargs):
+    """
+    Looks in your Amazon account for instances tagged with this Cluster.
+
+    Also looks inside your cluster for instances tagged with Types `app`,
+    `admin`, and `worker`. To put multiple types on an instance, list them
+    comma-delimited.
+    """
+    if not clusters:
+        abort("Tell me which cluster, like aws:<cluster>")
+    regions = kwargs.get('regions') or env.aws_regions or [None]
+    if isinstance(regions, basestring):
+        regions = regions.split()
+
+    instances = _aws_inventory(
+        clusters, regions, _to_bool(kwargs.get('refresh', False)))
+
+    servers = {'all': list()}
+    names = dict()
+    for i in instances:
+        name = i['dns']
+        if i['user']:
+            name = "%s@%s" % (i['user'], i['dns'])
+        servers['all'].append(name)
+        names[name] = i['name']
+        for t in i['types']:
+            if t in servers:
+                servers[t].append(name)
+            else:
+                servers[t] = [name]
+
+    if len(servers['all']) is 0:
+        raise Exception("No servers found")
+
+    env.settings = clusters[0]
+    env.user = 'newsapps'
+    #env.no_agent = True
+    #env.key_filename = '~/.vagrant.d/insecure_private_key'
+
+    env.hosts = servers['all']
+    print(colors.blue("--ALL THE SERVERS--"))
+    for h in env.hosts:
+        print colors.white(names[h]) + ' (%s)' % h
+
+    env.roledefs = {
+        'app': servers.get('app', list()),
+        'worker': servers.get('worker', list()),
+        'admin': servers.get('admin', list())
+    }
+    print(colors.blue("--SERVERS WITH JOBS--"))
+    for t, s in env.roledefs.items():
+        print colors.blue(t) + ': ' + ', '.join(
+            [colors.white(names[h]) for h in s])
+
+    env.path = '/home/%(user)s/sites/%(project_name)s' % env
+    env.env_path = '/home/%(user)s/.virtualenvs/%(project_name)s' % env
+    env.repo_path = env.path
+
+    env.s3_bucket = '%(project_name)s-%(settings)s' % env
+    #env.site_domain = '%(project_name)s.dev' % env
+
+    #env.db_root_user = 'postgres'
+    #env.db_root_pass = 'postgres'
+    #env.db_host = '192.168.33.10'
+
+    env.django_settings_module = '%(project_name)s.%(settings)s_settings' % env
+
 
-    ec2_conn = boto.connect_ec2()
-    _s3conn = S3Connection()
-
-    def aws(cluster):
-        """
-        Looks in your Amazon account for instances tagged with this Cluster.
-
-        Also looks inside your cluster for instances tagged with Types `app`,
-        `admin`, and `worker`. To put multiple types on an instance, list them
-        comma-delimited.
-        """
-        reservations = ec2_conn.get_all_instances(
-            filters={
-                'tag:Cluster': cluster,
-                'instance-state-name': 'running'
+def refresh_inventory(*clusters, **kwargs):
+    """
+    Look up clusters again instead of using the cached inventory. Without
+    any clusters, forget the whole cache so the next aws task looks again.
+    """
+    if not clusters:
+        if os.path.exists(env.aws_inventory_cache):
+            os.remove(env.aws_inventory_cache)
+        print(colors.green("Cleared %s" % env.aws_inventory_cache))
+        return
+    regions = kwargs.get('regions') or env.aws_regions or [None]
+    if isinstance(regions, basestring):
+        regions = regions.split()
+    instances = _aws_inventory(clusters, regions, True)
+    print(colors.green("Found %d instances" % len(instances)))
+
+
+def _aws_inventory(clusters, regions, refresh=False):
+    """
+    Returns the running instances in each cluster and region, from the
+    inventory cache when it's fresh. The rest are looked up concurrently.
+    """
+    def cache_key(pair):
+        return '%s/%s' % (pair[0], pair[1] or 'default')
+
+    cache = _load_aws_inventory()
+    now = time.time()
+    wanted = [(c, r) for c in clusters for r in regions]
+
+    stale = [pair for pair in wanted
+             if refresh or cache_key(pair) not in cache
+             or now - cache[cache_key(pair)]['time'] > env.aws_inventory_ttl]
+    if stale:
+        _import_for_threads('boto', 'boto.ec2')
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(len(stale))
+        try:
+            results = pool.map(
+                lambda pair: _fetch_aws_instances(*pair), stale)
+        finally:
+            pool.close()
+            pool.join()
+        for pair, instances in zip(stale, results):
+            cache[cache_key(pair)] = {'time': now, 'instances': instances}
+        _save_aws_inventory(cache)
+
+    instances = []
+    for pair in wanted:
+        instances.extend(cache[cache_key(pair)]['instances'])
+    return instances
+
+
+def _fetch_aws_instances(cluster, region=None):
+    """
+    Ask EC2 for the running instances tagged with a cluster.
+    """
+    if region is None:
+        ec2_conn = _lazy_import('boto').connect_ec2()
+    else:
+        ec2_conn = _lazy_import('boto.ec2').connect_to_region(region)
+    reservations = ec2_conn.get_all_instances(
+        filters={
+            'tag:Cluster': cluster,
+            'instance-state-name': 'running'
+        })
+
+    instances = []
+    for r in reservations:
+        for i in r.instances:
+            instances.append({
+                'dns': i.public_dns_name,
+                'name': i.tags.get('Name', ''),
+                'user': i.tags.get('User'),
+                'types': [t.strip().lower()
+                          for t in i.tags.get('Type', '').split(',')],
             })
+    return instances
+
 
-        servers = {'all': list()}
-        names = dict()
-        for r in reservations:
-            for i in r.instances:
-                name = i.public_dns_name
-                if 'User' in i.tags:
-                    name = "%s@%s" % (i.tags['User'], i.public_dns_name)
-                servers['all'].append(name)
-                names[i.public_dns_name] = i.tags.get('Name', '')
-                types = [t.strip().lower() for t in i.tags.get('Type', '').split(',')]
-                for t in types:
-                    if t in servers:
-                        servers[t].append(name)
-                    else:
-                        servers[t] = [name]
-
-        if len(servers['all']) is 0:
-            raise Exception("No servers found")
-
-        env.settings = cluster
-        env.user = 'newsapps'
-        #env.no_agent = True
-        #env.key_filename = '~/.vagrant.d/insecure_private_key'
-
-        env.hosts = servers['all']
-        print(colors.blue("--ALL THE SERVERS--"))
-        for h in env.hosts:
-            print colors.white(names[h]) + ' (%s)' % h
-
-        env.roledefs = {
-            'app': servers.get('app', list()),
-            'worker': servers.get('worker', list()),
-            'admin': servers.get('admin', list())
-        }
-        print(colors.blue("--SERVERS WITH JOBS--"))
-        for t, s in env.roledefs.items():
-            print colors.blue(t) + ': ' + ', '.join(
-                [colors.white(names[h]) for h in s])
-
-        env.path = '/home/%(user)s/sites/%(project_name)s' % env
-        env.env_path = '/home/%(user)s/.virtualenvs/%(project_name)s' % env
-        env.repo_path = env.path
-
-        env.s3_bucket = '%(project_name)s-%(settings)s' % env
-        #env.site_domain = '%(project_name)s.dev' % env
-
-        #env.db_root_user = 'postgres'
-        #env.db_root_pass = 'postgres'
-        #env.db_host = '192.168.33.10'
-
-        env.django_settings_module = '%(project_name)s.%(settings)s_settings' % env
-
-    def deploy_to_s3():
-        directory = os.path.abspath("%(repo_path)s/%(project_name)s/assets" % env)
-        return _deploy_to_s3(directory, env.s3_bucket)
-
-    def _deploy_to_s3(directory, bucket):
-        """
-        Deploy a directory to an s3 bucket, gzipping what can be gzipped.
-        Make sure you have the a boto config file, or have AWS_ACCESS_KEY_ID and
-        AWS_SECRET_ACCESS_KEY environment variables.
-        """
-        directory = directory.rstrip('/')
-
-        tempdir = tempfile.mkdtemp(env['project_name'])
-
-        conn = _s3conn
-        bucket = conn.get_bucket(bucket)
-        existing_key_dict = dict((k.name, k) for k in bucket.list(env.project_name))
-        for keyname, absolute_path in _find_file_paths(directory):
-            remote_keyname = _s3_upload(keyname, absolute_path, bucket, tempdir)
-            try:
-                del existing_key_dict[remote_keyname]
-            except:
-                pass
-
-        for key_obj in existing_key_dict.values():
-            key_obj.delete()
-        shutil.rmtree(tempdir, True)
+def _load_aws_inventory():
+    import json
+    try:
+        with open(env.aws_inventory_cache) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_aws_inventory(cache):
+    import json
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(env.aws_inventory_cache))
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(cache, fp)
+    os.rename(temp_path, env.aws_inventory_cache)
+
+
+env.s3_upload_workers = 8
+env.s3_upload_retries = 3
+env.s3_retry_backoff = 0.5
+env.s3_gzip_level = 6
+env.s3_gzip_max_ratio = 0.9
+env.s3_spool_size = 8 * 1024 * 1024
+env.s3_multipart_threshold = 64 * 1024 * 1024
+env.s3_multipart_chunk_size = 16 * 1024 * 1024
+env.s3_compress_types = [
+    'text/*',
+    'application/javascript',
+    'application/x-javascript',
+    'application/json',
+    'application/xml',
+    'application/rss+xml',
+    'image/svg+xml',
+    'image/x-icon',
+    'application/vnd.ms-fontobject',
+    'font/ttf',
+    'font/otf',
+]
+# Brotli copies go up next to the gzipped files as <key>.br. S3 can't pick
+# between them, so only turn this on if a CDN or proxy in front of the
+# bucket serves <key>.br to clients that send Accept-Encoding: br
+env.s3_brotli = False
+env.s3_brotli_quality = 11
+env.s3_fingerprint = False
+env.s3_cache_control = None
+env.s3_immutable_cache_control = 'public, max-age=31536000, immutable'
+env.s3_delete_limit = 5000  # 0 for no limit
+env.s3_releases = False
+env.s3_releases_keep = 5  # releases or fingerprints
+
+
+def deploy_to_s3(dry_run=False):
+    """
+    Deploy the project's assets directory to its s3 bucket. Pass
+    dry_run=True to see what would be uploaded, skipped and deleted.
+    """
+    directory = os.path.abspath("%(repo_path)s/%(project_name)s/assets" % env)
+    return _deploy_to_s3(directory, env.s3_bucket, _to_bool(dry_run))
+
+
+def verify_s3_manifest():
+    """
+    Check the local asset manifest against the s3 bucket. Entries that
+    don't match the bucket are dropped, so the next deploy_to_s3 uploads
+    those files again.
+    """
+    directory = os.path.abspath("%(repo_path)s/%(project_name)s/assets" % env)
+    return _verify_s3_manifest(directory, env.s3_bucket)
+
+
+def _deploy_to_s3(directory, bucket, dry_run=False):
+    """
+    Deploy a directory to an s3 bucket, gzipping what can be gzipped.
+    Make sure you have the a boto config file, or have AWS_ACCESS_KEY_ID and
+    AWS_SECRET_ACCESS_KEY environment variables.
+    """
+    directory = directory.rstrip('/')
+    _add_mimetypes()
+    _import_for_threads('boto.s3.connection', 'boto.s3.key')
+
+    fingerprint = None
+    if env.s3_fingerprint or env.s3_releases:
+        fingerprint = _cachebuster()
+
+    manifest_path = _s3_manifest_path(directory, bucket)
+    manifest = _load_s3_manifest(manifest_path, bucket)
+    if manifest is None:
+        print(colors.yellow(
+            "No usable manifest at %s, checking against the bucket "
+            "listing" % manifest_path))
+        remote_etags = dict(
+            (k.name, k.etag.strip('"'))
+            for k in _s3_bucket(bucket).list(env.project_name))
+        old_entries = {}
+    else:
+        remote_etags = {}
+        old_entries = manifest
+    stale_keys = set(remote_etags.keys())
+    for entry in old_entries.values():
+        stale_keys.update(k for k, etag in _s3_entry_keys(entry))
+    if fingerprint:
+        # Other releases are cleaned up by _prune_s3_releases
+        stale_keys = set(k for k in stale_keys
+                         if _s3_key_release(k, [fingerprint]))
+
+    def upload(item):
+        keyname, absolute_path = item
+        try:
+            changed, entry = _s3_retry(
+                _s3_upload, keyname, absolute_path, bucket,
+                entry=old_entries.get(keyname),
+                remote_etags=remote_etags, fingerprint=fingerprint,
+                dry_run=dry_run)
+        except Exception as e:
+            return keyname, None, None, e
+        return keyname, changed, entry, None
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(env.s3_upload_workers)
+    start = time.time()
+    uploaded = 0
+    copied = 0
+    skipped = 0
+    total_bytes = 0
+    failures = []
+    new_entries = {}
+    try:
+        for keyname, changed, entry, error in pool.imap_unordered(
+                upload, _find_file_paths(directory)):
+            if error is not None:
+                key_name = _s3_keyname(keyname, fingerprint)
+                stale_keys.difference_update([key_name, key_name + '.br'])
+                failures.append((keyname, error))
+                continue
+            stale_keys.difference_update(
+                k for k, etag in _s3_entry_keys(entry))
+            new_entries[keyname] = entry
+            if changed == 'copied':
+                copied += 1
+            elif changed:
+                uploaded += 1
+                total_bytes += entry['size']
+            else:
+                skipped += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    if dry_run:
+        print(colors.yellow(
+            "Dry run: would upload %d files (%.1f MB), copy %d, skip %d "
+            "unchanged files and delete %d stale keys" % (
+                uploaded, total_bytes / 1048576.0, copied, skipped,
+                len(stale_keys))))
         return True
 
-    def _s3_upload(keyname, absolute_path, bucket, tempdir):
-        """
-        Upload a file to s3
-        """
-        mimetype = mimetypes.guess_type(absolute_path)
-        options = {'Content-Type': mimetype[0]}
-
-        key_parts = keyname.split('/')
-        filename = key_parts.pop()
-
-        if mimetype[0] is not None and mimetype[0].startswith('text/'):
-            upload = open(absolute_path)
-            options['Content-Encoding'] = 'gzip'
-            temp_path = os.path.join(tempdir, filename)
-            gzfile = gzip.open(temp_path, 'wb')
-            gzfile.write(upload.read())
+    elapsed = max(time.time() - start, 0.001)
+    print(colors.green(
+        "Uploaded %d files (%.1f MB) in %.1fs: %.1f files/s, %.2f MB/s. "
+        "Copied %d and skipped %d unchanged files." % (
+            uploaded, total_bytes / 1048576.0, elapsed,
+            uploaded / elapsed, total_bytes / 1048576.0 / elapsed,
+            copied, skipped)))
+
+    if failures:
+        for keyname, error in failures:
+            print(colors.red("Failed to upload %s: %s" % (keyname, error)))
+        if manifest is not None:
+            # Failed and stale files keep their old entries, so they are
+            # retried and cleaned up next time
+            manifest.update(new_entries)
+            _save_s3_manifest(manifest_path, bucket, manifest)
+        abort("%d files failed to upload to %s, not removing stale keys"
+              % (len(failures), bucket))
+
+    if env.s3_delete_limit and len(stale_keys) > env.s3_delete_limit:
+        if manifest is not None:
+            manifest.update(new_entries)
+            _save_s3_manifest(manifest_path, bucket, manifest)
+        abort("%d stale keys to delete from %s, more than env.s3_delete_limit "
+              "(%d). Check with dry_run=True and raise the limit if that's "
+              "right." % (len(stale_keys), bucket, env.s3_delete_limit))
+
+    errors = _delete_s3_keys(bucket, sorted(stale_keys))
+    if errors:
+        for key_name, error in errors:
+            print(colors.red("Failed to delete %s: %s" % (key_name, error)))
+        if manifest is not None:
+            manifest.update(new_entries)
+            _save_s3_manifest(manifest_path, bucket, manifest)
+        abort("%d stale keys couldn't be deleted from %s" % (
+            len(errors), bucket))
+
+    _save_s3_manifest(manifest_path, bucket, new_entries)
+    if fingerprint:
+        _prune_s3_releases(bucket, fingerprint)
+    return True
+
+
+def _prune_s3_releases(bucket, release):
+    """
+    Record release as the newest in the bucket, and delete the releases
+    older than the last env.s3_releases_keep.
+    """
+    import json
+    s3_bucket = _s3_bucket(bucket)
+    index_name = '%s/releases.json' % env.project_name
+    index = s3_bucket.get_key(index_name)
+    releases = json.loads(index.get_contents_as_string()) if index else [None]
+    releases = [r for r in releases if r != release] + [release]
+
+    keep = max(int(env.s3_releases_keep), 1)
+    old_releases = releases[:-keep]
+    if old_releases:
+        kept = releases[-keep:]
+        keys = []
+        for k in s3_bucket.list('%s/site_media/' % env.project_name):
+            if _s3_key_release(k.name, old_releases):
+                keys.append(k.name)
+            elif None in old_releases and not _s3_key_release(k.name, kept):
+                keys.append(k.name)
+        for old in old_releases:
+            if old is not None:
+                keys.extend(k.name for k in s3_bucket.list(
+                    '%s/releases/%s/' % (env.project_name, old)))
+        names = ', '.join(old or 'site_media' for old in old_releases)
+        print("Removing releases %s" % names)
+        errors = _delete_s3_keys(bucket, keys)
+        if errors:
+            abort("%d keys in releases %s couldn't be deleted from %s" % (
+                len(errors), names, bucket))
+
+    index = _lazy_import('boto.s3.key').Key(s3_bucket)
+    index.key = index_name
+    index.set_contents_from_string(json.dumps(releases[-keep:]))
+
+
+def _delete_s3_keys(bucket, key_names):
+    """
+    Delete keys from an s3 bucket with multi-object deletes of up to 1000
+    keys, env.s3_upload_workers at a time, and report what went. Returns
+    the keys that couldn't be deleted, with why.
+    """
+    if not key_names:
+        return []
+
+    def delete(batch):
+        try:
+            result = _s3_retry(
+                _s3_bucket(bucket).delete_keys, batch, quiet=True)
+        except Exception as e:
+            return [(key_name, e) for key_name in batch]
+        return [(error.key, '%s %s' % (error.code, error.message))
+                for error in result.errors]
+
+    batches = [key_names[i:i + 1000] for i in range(0, len(key_names), 1000)]
+    _import_for_threads('boto.s3.connection')
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(env.s3_upload_workers, len(batches)))
+    start = time.time()
+    try:
+        errors = sum(pool.map(delete, batches), [])
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = set(key_name for key_name, error in errors)
+    directories = {}
+    for key_name in key_names:
+        if key_name not in failed:
+            directory = os.path.dirname(key_name) or '/'
+            directories[directory] = directories.get(directory, 0) + 1
+    print(colors.green("Deleted %d stale keys in %d requests in %.1fs" % (
+        len(key_names) - len(failed), len(batches), time.time() - start)))
+    for directory, count in sorted(directories.items()):
+        print("  %5d  %s" % (count, directory))
+    return errors
+
+
+def _verify_s3_manifest(directory, bucket):
+    """
+    Compare a directory's manifest with the keys in the bucket, and drop
+    the entries that are missing or have a different etag.
+    """
+    directory = directory.rstrip('/')
+    manifest_path = _s3_manifest_path(directory, bucket)
+    manifest = _load_s3_manifest(manifest_path, bucket)
+    if manifest is None:
+        abort("No usable manifest at %s, the next deploy_to_s3 will "
+              "rebuild it" % manifest_path)
+
+    # Other releases aren't in the manifest
+    prefix = env.project_name
+    if env.s3_releases:
+        prefix = _s3_keyname('', _cachebuster())
+    remote_etags = dict(
+        (k.name, k.etag.strip('"'))
+        for k in _s3_bucket(bucket).list(prefix))
+
+    mismatched = []
+    for keyname, entry in manifest.items():
+        for key_name, etag in _s3_entry_keys(entry):
+            if remote_etags.pop(key_name, None) != etag:
+                mismatched.append(keyname)
+                del manifest[keyname]
+                break
+
+    for keyname in sorted(mismatched):
+        print(colors.red("Out of sync: %s" % keyname))
+    if remote_etags:
+        print(colors.yellow(
+            "%d keys in the bucket aren't in the manifest. Delete %s to "
+            "have the next deploy clean them up." % (
+                len(remote_etags), manifest_path)))
+    if mismatched:
+        _save_s3_manifest(manifest_path, bucket, manifest)
+        print(colors.yellow(
+            "Dropped %d entries, the next deploy will upload them again"
+            % len(mismatched)))
+    else:
+        print(colors.green("Manifest matches %s" % bucket))
+    return not mismatched
+
+
+def _s3_upload(keyname, absolute_path, bucket, entry=None,
+               remote_etags=None, fingerprint=None, dry_run=False):
+    """
+    Upload a file to s3, unless it's unchanged since its manifest entry or
+    remote_etags. Returns whether it was uploaded, and its new entry.
+    """
+    stat = os.stat(absolute_path)
+    key_name = _s3_keyname(keyname, fingerprint)
+    headers = _s3_headers(absolute_path, fingerprint)
+
+    if entry is not None and entry['key'] == key_name:
+        if entry.get('headers') != headers:
+            remote_etags = {}
+        elif (entry['size'] == stat.st_size
+                and entry['mtime'] == stat.st_mtime):
+            return False, entry
+        else:
+            remote_etags = dict(_s3_entry_keys(entry))
+    elif entry is not None:
+        if (entry.get('headers') == headers
+                and entry['size'] == stat.st_size
+                and (entry['mtime'] == stat.st_mtime
+                     or entry['md5'] == _file_md5(absolute_path)[0])):
+            return _s3_copy(entry, key_name, bucket, stat, dry_run)
+        entry = None
+        remote_etags = {}
+    elif remote_etags is None:
+        remote_etags = {}
+
+    content_md5 = _file_md5(absolute_path)
+    new_entry = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'md5': content_md5[0],
+        'key': key_name,
+        'headers': headers,
+    }
+    if (entry is not None and remote_etags
+            and entry['md5'] == content_md5[0]):
+        new_entry['etag'] = entry['etag']
+        if 'br_etag' in entry:
+            new_entry['br_etag'] = entry['br_etag']
+        return False, new_entry
+
+    variants = [('etag', key_name, None)]
+    if _s3_compressible(headers['Content-Type']):
+        variants = [('etag', key_name, 'gzip')]
+        if env.s3_brotli and _lazy_import('brotli', False) is not None:
+            variants.append(('br_etag', key_name + '.br', 'br'))
+
+    changed = False
+    for field, variant_key, encoding in variants:
+        variant_headers = dict(headers)
+        body = None
+        if encoding is not None:
+            body = _compress_body(absolute_path, stat.st_size, encoding)
+            if body is not None:
+                variant_headers['Content-Encoding'] = encoding
+            elif field != 'etag':
+                # Only the main key is uploaded uncompressed
+                continue
+        if body is None:
+            body = open(absolute_path, 'rb')
+
+        try:
+            if ('Content-Encoding' in variant_headers
+                    or stat.st_size >= env.s3_multipart_threshold):
+                etag, md5 = _s3_etag(body)
+            else:
+                etag, md5 = content_md5[0], content_md5
+
+            new_entry[field] = etag
+            if etag == remote_etags.get(variant_key):
+                continue
+
+            if not dry_run:
+                _s3_put(_s3_bucket(bucket), variant_key, body,
+                        variant_headers, md5)
+            changed = True
+        finally:
+            body.close()
+    return changed, new_entry
+
+
+def _s3_copy(entry, key_name, bucket, stat, dry_run=False):
+    """
+    Copy the keys in a manifest entry to key_name, inside s3, keeping their
+    headers. Returns 'copied' and the new manifest entry.
+    """
+    new_entry = dict(entry, key=key_name, mtime=stat.st_mtime)
+    if not dry_run:
+        s3_bucket = _s3_bucket(bucket)
+        for old_key, etag in _s3_entry_keys(entry):
+            # The brotli copy's key has a .br suffix on the same name
+            new_key = key_name + old_key[len(entry['key']):]
+            copy = s3_bucket.copy_key(new_key, bucket, old_key,
+                                      headers={'x-amz-acl': 'public-read'})
+            field = 'etag' if old_key == entry['key'] else 'br_etag'
+            new_entry[field] = copy.etag.strip('"')
+    return 'copied', new_entry
+
+
+def _s3_headers(absolute_path, fingerprint=None):
+    """
+    The headers a file is uploaded with, before any Content-Encoding.
+    Fingerprinted files never change, so they can be cached forever.
+    """
+    import mimetypes
+    headers = {
+        'Content-Type': (mimetypes.guess_type(absolute_path)[0]
+                         or 'application/octet-stream'),
+    }
+    if fingerprint:
+        headers['Cache-Control'] = env.s3_immutable_cache_control
+    elif env.s3_cache_control:
+        headers['Cache-Control'] = env.s3_cache_control
+    return headers
+
+
+def _s3_compressible(content_type):
+    """
+    Whether a content type matches one of `env.s3_compress_types`.
+    """
+    import fnmatch
+    return any(fnmatch.fnmatch(content_type, pattern)
+               for pattern in env.s3_compress_types)
+
+
+def _s3_entry_keys(entry):
+    """
+    The keys a manifest entry was uploaded to, with their etags.
+    """
+    keys = [(entry['key'], entry['etag'])]
+    if 'br_etag' in entry:
+        keys.append((entry['key'] + '.br', entry['br_etag']))
+    return keys
+
+
+def _s3_put(s3_bucket, key_name, body, headers, md5):
+    """
+    Upload a file object to a key, in parts if it's bigger than
+    `env.s3_multipart_threshold`.
+    """
+    body.seek(0, os.SEEK_END)
+    size = body.tell()
+    body.seek(0)
+
+    if size < env.s3_multipart_threshold:
+        k = _lazy_import('boto.s3.key').Key(s3_bucket)
+        k.key = key_name
+        k.set_contents_from_file(
+            body, headers, policy='public-read', md5=md5)
+        return
+
+    mp = s3_bucket.initiate_multipart_upload(
+        key_name, headers=headers, policy='public-read')
+    try:
+        part_num = 0
+        for offset in range(0, size, env.s3_multipart_chunk_size):
+            part_num += 1
+            body.seek(offset)
+            mp.upload_part_from_file(
+                body, part_num,
+                size=min(env.s3_multipart_chunk_size, size - offset))
+        mp.complete_upload()
+    except:
+        mp.cancel_upload()
+        raise
+
+
+def _s3_manifest_path(directory, bucket):
+    """
+    Where the manifest for deploying a directory to a bucket lives. Set
+    `env.s3_manifest` to override, otherwise it sits next to the
+    directory. Don't commit it, it describes what this machine uploaded.
+    """
+    if env.get('s3_manifest'):
+        return env.s3_manifest
+    return os.path.join(
+        os.path.dirname(directory), '.s3manifest-%s.json' % bucket)
+
+
+def _load_s3_manifest(path, bucket):
+    """
+    Returns the files in a manifest keyed by relative path, or None if the
+    manifest is missing, unreadable or for another bucket.
+    """
+    import json
+    try:
+        with open(path) as fp:
+            manifest = json.load(fp)
+        if (manifest['version'] != S3_MANIFEST_VERSION
+                or manifest['bucket'] != bucket):
+            return None
+        files = manifest['files']
+        for entry in files.values():
+            if any(field not in entry for field in
+                   ('size', 'mtime', 'md5', 'etag', 'key')):
+                return None
+        return files
+    except (IOError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def _save_s3_manifest(path, bucket, files):
+    """
+    Atomically replace a manifest.
+    """
+    import json
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as fp:
+        json.dump({
+            'version': S3_MANIFEST_VERSION,
+            'bucket': bucket,
+            'files': files,
+        }, fp)
+    os.rename(temp_path, path)
+
+
+def _compress_body(absolute_path, size, encoding):
+    """
+    Gzip or brotli a file into a spooled buffer, or return None if that
+    doesn't make it any smaller than env.s3_gzip_max_ratio.
+    """
+    import gzip
+    import shutil
+    import tempfile
+    body = tempfile.SpooledTemporaryFile(max_size=env.s3_spool_size)
+    with open(absolute_path, 'rb') as upload:
+        if encoding == 'br':
+            compressor = _lazy_import('brotli').Compressor(
+                quality=env.s3_brotli_quality)
+            for chunk in iter(lambda: upload.read(S3_CHUNK_SIZE), ''):
+                body.write(compressor.process(chunk))
+            body.write(compressor.finish())
+        else:
+            # No name or time in the header, so the etag only changes with
+            # the file
+            gzfile = gzip.GzipFile(
+                filename='', mode='wb', fileobj=body, mtime=0,
+                compresslevel=env.s3_gzip_level)
+            shutil.copyfileobj(upload, gzfile, S3_CHUNK_SIZE)
             gzfile.close()
-            absolute_path = temp_path
-
-        k = Key(bucket)
-        k.key = '%s/site_media/%s' % (env.project_name, keyname)
-        k.set_contents_from_filename(absolute_path, options, policy='public-read')
-        return k.key
-
-    def _find_file_paths(directory):
-        """
-        A generator function that recursively finds all files in the
-        upload directory.
-        """
-        for root, dirs, files in os.walk(directory):
-            rel_path = os.path.relpath(root, directory)
-            for f in files:
-                if rel_path == '.':
-                    yield (f, os.path.join(root, f))
-                else:
-                    yield (os.path.join(rel_path, f), os.path.join(root, f))
-except ImportError:
-    def aws(cluster):
-        print(colors.red("You must install boto!"))
+
+    if body.tell() > size * env.s3_gzip_max_ratio:
+        body.close()
+        return None
+    body.seek(0)
+    return body
+
+
+def _stream_md5(fp, limit=None):
+    """
+    Returns a hashlib md5 of the rest of a file object, or of the next
+    `limit` bytes of it.
+    """
+    import hashlib
+    md5 = hashlib.md5()
+    while limit is None or limit > 0:
+        chunk_size = S3_CHUNK_SIZE
+        if limit is not None:
+            chunk_size = min(chunk_size, limit)
+            limit -= chunk_size
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        md5.update(chunk)
+    return md5
+
+
+def _file_md5(path):
+    """
+    Returns the hex and base64 md5 digests of a file, as boto wants them.
+    """
+    import base64
+    with open(path, 'rb') as fp:
+        md5 = _stream_md5(fp)
+    return md5.hexdigest(), base64.b64encode(md5.digest())
+
+
+def _s3_etag(body):
+    """
+    Returns the etag s3 will give a file object once _s3_put uploads it,
+    and the md5 digests boto wants for a single part upload (None for a
+    multipart one).
+    """
+    import base64
+    import hashlib
+    body.seek(0, os.SEEK_END)
+    size = body.tell()
+    body.seek(0)
+
+    if size < env.s3_multipart_threshold:
+        md5 = _stream_md5(body)
+        body.seek(0)
+        return md5.hexdigest(), (
+            md5.hexdigest(), base64.b64encode(md5.digest()))
+
+    # Multipart etags are the md5 of the parts' md5s, plus the part count
+    digests = []
+    for offset in range(0, size, env.s3_multipart_chunk_size):
+        digests.append(
+            _stream_md5(body, env.s3_multipart_chunk_size).digest())
+    body.seek(0)
+    return '%s-%d' % (
+        hashlib.md5(''.join(digests)).hexdigest(), len(digests)), None
+
+
+def _add_mimetypes():
+    """
+    Not every system's mime.types knows about these. Loading mime.types is
+    slow, so it waits until there's something to upload.
+    """
+    import mimetypes
+    mimetypes.add_type('application/javascript', '.js')
+    mimetypes.add_type('application/json', '.json')
+    mimetypes.add_type('image/svg+xml', '.svg')
+    mimetypes.add_type('application/vnd.ms-fontobject', '.eot')
+    mimetypes.add_type('font/ttf', '.ttf')
+    mimetypes.add_type('font/otf', '.otf')
+    mimetypes.add_type('font/woff', '.woff')
+    mimetypes.add_type('font/woff2', '.woff2')
+
+
+def _s3_keyname(keyname, fingerprint=None):
+    """
+    The remote key a file from the asset directory is uploaded to. With a
+    fingerprint, `js/app.js` goes to `js/app.<fingerprint>.js`, or to
+    `releases/<fingerprint>/js/app.js` with `env.s3_releases` set.
+    """
+    if fingerprint and env.s3_releases:
+        return '%s/releases/%s/%s' % (env.project_name, fingerprint, keyname)
+    if fingerprint:
+        root, ext = os.path.splitext(keyname)
+        keyname = '%s.%s%s' % (root, fingerprint, ext)
+    return '%s/site_media/%s' % (env.project_name, keyname)
+
+
+def _s3_key_release(key_name, releases):
+    """
+    Which of releases a key was uploaded for, going by the release prefix
+    it's under or the fingerprint in its name (see _s3_keyname). None if
+    it isn't one of theirs.
+    """
+    prefix = '%s/releases/' % env.project_name
+    if key_name.startswith(prefix):
+        release = key_name[len(prefix):].split('/')[0]
+        return release if release in releases else None
+    if key_name.endswith('.br'):
+        key_name = key_name[:-len('.br')]
+    name = key_name.rsplit('/', 1)[-1] + '.'
+    for release in releases:
+        if release and '.%s.' % release in name:
+            return release
+    return None
+
+
+def _s3_bucket(bucket):
+    """
+    Return a bucket object for the current thread. Every thread gets its
+    own S3Connection so boto can keep reusing that thread's pooled HTTP
+    connections.
+    """
+    if not hasattr(_s3_local, 'conn'):
+        _s3_local.conn = _lazy_import('boto.s3.connection').S3Connection()
+        _s3_local.buckets = {}
+    if bucket not in _s3_local.buckets:
+        _s3_local.buckets[bucket] = _s3_local.conn.get_bucket(
+            bucket, validate=False)
+    return _s3_local.buckets[bucket]
+
+
+def _s3_retry(func, *args, **kwargs):
+    """
+    Call func, retrying with exponential backoff if it raises.
+    """
+    for attempt in range(env.s3_upload_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if attempt == env.s3_upload_retries:
+                raise
+            time.sleep(env.s3_retry_backoff * (2 ** attempt))
+
+
+def _find_file_paths(directory):
+    """
+    A generator function that recursively finds all files in the
+    upload directory.
+    """
+    for root, dirs, files in os.walk(directory):
+        rel_path = os.path.relpath(root, directory)
+        for f in files:
+            if rel_path == '.':
+                yield (f, os.path.join(root, f))
+            else:
+                yield (os.path.join(rel_path, f), os.path.join(root, f))
@@ -0,0 +1,25 @@
+"""
+Gunicorn server hooks, loaded by run_server.sh with --config.
+
+Each worker that has loaded the app touches /tmp/gunicorn-<master pid>.booted,
+so fab reload_gunicorn can tell when the workers of a new master started
+with USR2 are up, before it retires the old master.
+"""
+import os
+
+
+def post_worker_init(worker):
+    """
+    Record that a worker of this master loaded the app.
+    """
+    open('/tmp/gunicorn-%d.booted' % worker.ppid, 'a').close()
+
+
+def on_exit(server):
+    """
+    Clean up the master's record when it stops.
+    """
+    try:
+        os.unlink('/tmp/gunicorn-%d.booted' % server.pid)
+    except OSError:
+        pass
@@ -4,8 +4,13 @@ E_BADARGS=65
 
 if [ $# -lt $EXPECTED_ARGS ]
 then
-  echo "Usage: `basename $0` <deploy target> <projectname> [num workers] [site]"
+  echo "Usage: `basename $0` <deploy target> <projectname> [num workers|auto] [site]"
   echo "Run a gunicorn server for the app in /home/newsapps/sites/projectname."
+  echo "With auto workers, runs 2 per CPU plus 1, as many as fit in memory at"
+  echo "GUNICORN_WORKER_MEMORY MB each, with the CPUs and memory split between"
+  echo "the GUNICORN_SERVICES gunicorn services on the host. GUNICORN_WORKER_CLASS,"
+  echo "GUNICORN_MAX_REQUESTS, GUNICORN_MAX_REQUESTS_JITTER and"
+  echo "GUNICORN_PRELOAD=true change the rest of the gunicorn settings."
   exit $E_BADARGS
 fi
 
@@ -14,14 +19,22 @@ PROJECT=$2
 WORKERS=${3:-'2'}
 SITE=${4:-''}
 
+WORKER_CLASS=${GUNICORN_WORKER_CLASS:-'gevent'}
+WORKER_MEMORY=${GUNICORN_WORKER_MEMORY:-'150'}
+MAX_REQUESTS=${GUNICORN_MAX_REQUESTS:-'1000'}
+SERVICES=${GUNICORN_SERVICES:-'1'}
+
 USE_ACCOUNT=www-data
+HOOKS=`dirname $0`/gunicorn_hooks.py
 ROOT=/home/newsapps/sites/$PROJECT
 GUNICORN=/home/newsapps/.virtualenvs/$PROJECT/bin/gunicorn
 if [ -z "$SITE" ]
 then
   SOCKET=/tmp/${PROJECT}.sock
+  PIDFILE=/tmp/${PROJECT}.pid
 else
   SOCKET=/tmp/${PROJECT}_${SITE}.sock
+  PIDFILE=/tmp/${PROJECT}_${SITE}.pid
 fi
 ERROR_LOG=/home/newsapps/logs/${PROJECT}.error.log
 SECRETS=/home/newsapps/sites/secrets/${TARGET}_secrets.sh
@@ -65,10 +78,65 @@ then
   . $SENDGRID
 fi
 
+if [ "$WORKERS" = "auto" ]
+then
+  CPUS=`nproc 2>/dev/null || getconf _NPROCESSORS_ONLN`
+  MEMORY=`awk '/^MemAvailable:/ { print int($2 / 1024) }' /proc/meminfo`
+  if [ -z "$MEMORY" ]
+  then
+    MEMORY=`awk '/^MemTotal:/ { print int($2 / 1024) }' /proc/meminfo`
+  fi
+  # Each gunicorn service on the host gets its share
+  WORKERS=$((CPUS * 2 / SERVICES + 1))
+  if [ $((MEMORY / SERVICES / WORKER_MEMORY)) -lt $WORKERS ]
+  then
+    WORKERS=$((MEMORY / SERVICES / WORKER_MEMORY))
+  fi
+  if [ $WORKERS -lt 1 ]
+  then
+    WORKERS=1
+  fi
+fi
+
+if [ "$GUNICORN_PRELOAD" = "true" ]
+then
+  PRELOAD=--preload
+fi
+
+if [ -n "$GUNICORN_MAX_REQUESTS_JITTER" ]
+then
+  # Needs gunicorn 19.2 or later
+  JITTER=--max-requests-jitter=$GUNICORN_MAX_REQUESTS_JITTER
+fi
+
 cd $ROOT
-exec $GUNICORN --bind=unix:$SOCKET --workers=$WORKERS \
-    --keep-alive=0 --max-requests=1000 --user=www-data \
-    --group=$USE_ACCOUNT --name=$PROJECT \
-    --worker-class=gevent --error-logfile=$ERROR_LOG \
-    $WSGI_MODULE
+rm -f $PIDFILE $PIDFILE.2 $PIDFILE.oldbin
+$GUNICORN --config=$HOOKS --bind=unix:$SOCKET --workers=$WORKERS \
+    --pid=$PIDFILE --keep-alive=0 --max-requests=$MAX_REQUESTS $JITTER \
+    --user=www-data --group=$USE_ACCOUNT --name=$PROJECT $PRELOAD \
+    --worker-class=$WORKER_CLASS --error-logfile=$ERROR_LOG \
+    $WSGI_MODULE &
+MASTER=$!
+
+# A USR2 upgrade replaces the gunicorn master with a new process, so rather
+# than exec gunicorn, stay around for runit and follow the pid file to
+# whichever master is current, passing runit's signals on to it. While an
+# upgrade is under way the new master's pid is in $PIDFILE.2, or with
+# older gunicorns the old master's is in $PIDFILE.oldbin. The pid file is
+# re-read on every check, since the new master can rename $PIDFILE.2 over it
+# between one kill -0 and the next.
+trap 'kill -HUP $MASTER' HUP
+trap 'kill -TERM $MASTER' TERM
+trap 'kill -INT $MASTER' INT
+while kill -0 `cat $PIDFILE 2>/dev/null` 2>/dev/null || \
+    kill -0 $MASTER 2>/dev/null || \
+    kill -0 `cat $PIDFILE.2 2>/dev/null` 2>/dev/null || \
+    kill -0 `cat $PIDFILE.oldbin 2>/dev/null` 2>/dev/null
+do
+  sleep 1
+  if [ -s $PIDFILE ]
+  then
+    MASTER=`cat $PIDFILE`
+  fi
+done
 
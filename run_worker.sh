@@ -4,8 +4,11 @@ E_BADARGS=65
 
 if [ $# -lt $EXPECTED_ARGS ]
 then
-  echo "Usage: `basename $0` <deploy target> <projectname> [num workers]"
+  echo "Usage: `basename $0` <deploy target> <projectname> [num workers] [site]"
   echo "Run a celery server for the app in /home/newsapps/sites/projectname."
+  echo "CELERY_QUEUE picks the queue to work on, CELERY_POOL the pool,"
+  echo "CELERY_AUTOSCALE=max,min scales instead of running num workers and"
+  echo "CELERY_PREFETCH_MULTIPLIER sets how many tasks each one reserves."
   exit $E_BADARGS
 fi
 
@@ -14,6 +17,9 @@ PROJECT=$2
 WORKERS=${3:-'2'}
 SITE=${4:-''}
 
+POOL=${CELERY_POOL:-'gevent'}
+MAX_TASKS_PER_CHILD=${CELERY_MAX_TASKS_PER_CHILD:-'100'}
+
 USE_ACCOUNT=www-data
 ROOT=/home/newsapps/sites/$PROJECT
 VIRTUAL_ENV=/home/newsapps/.virtualenvs/$PROJECT
@@ -23,6 +29,23 @@ SECRETS=/home/newsapps/sites/secrets/${TARGET}_secrets.sh
 SENDGRID=/home/newsapps/sites/secrets/sendgrid_secrets.sh
 HOSTNAME=${PROJECT}.`hostname`
 
+if [ -n "$CELERY_QUEUE" ]
+then
+  QUEUE_OPTION="--queues=$CELERY_QUEUE"
+  HOSTNAME=${CELERY_QUEUE}.${HOSTNAME}
+fi
+if [ -n "$CELERY_AUTOSCALE" ]
+then
+  SCALE_OPTION="--autoscale=$CELERY_AUTOSCALE"
+else
+  SCALE_OPTION="--concurrency=$WORKERS"
+fi
+if [ -n "$CELERY_PREFETCH_MULTIPLIER" ]
+then
+  # Settings without a command line option go after --
+  CONFIG="-- celeryd.prefetch_multiplier=$CELERY_PREFETCH_MULTIPLIER"
+fi
+
 if [ -f $ROOT/application.py ]
 then
   CELERY="celery worker --hostname=${HOSTNAME}"
@@ -50,6 +73,6 @@ fi
 
 . $VIRTUAL_ENV/bin/activate
 cd $ROOT
-exec chpst -u $USE_ACCOUNT $CELERY \
-    --concurrency=$WORKERS --pool=gevent --logfile=$WORKER_ERROR_LOG \
-    --events --maxtasksperchild=100
+exec chpst -u $USE_ACCOUNT $CELERY $QUEUE_OPTION \
+    $SCALE_OPTION --pool=$POOL --logfile=$WORKER_ERROR_LOG \
+    --events --maxtasksperchild=$MAX_TASKS_PER_CHILD $CONFIG
@@ -0,0 +1,47 @@
+"""
+Tests for fablib's helpers. Run them from the root of this repo with
+python -m unittest discover
+"""
+import unittest
+
+from fabric.api import env
+from fabric.operations import _AttributeString
+
+import fablib
+
+
+class FablibTestCase(unittest.TestCase):
+    """
+    Patches fablib and env for a test, and puts them back afterwards.
+    """
+    def setUp(self):
+        self._saved_env = dict(env)
+        self._saved_attrs = []
+
+    def tearDown(self):
+        for name, value in reversed(self._saved_attrs):
+            setattr(fablib, name, value)
+        env.clear()
+        env.update(self._saved_env)
+
+    def patch(self, name, value):
+        self._saved_attrs.append((name, getattr(fablib, name)))
+        setattr(fablib, name, value)
+
+    def patch_run(self, *outputs, **kwargs):
+        """
+        Replace run with one that returns each of outputs in turn, and
+        return the list of commands it was given.
+        """
+        commands = []
+        outputs = list(outputs)
+        failed = kwargs.get('failed', False)
+
+        def run(command, *args, **kw):
+            commands.append(command)
+            result = _AttributeString(outputs.pop(0))
+            result.failed = failed
+            result.succeeded = not failed
+            return result
+        self.patch('run', run)
+        return commands
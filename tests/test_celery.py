@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import time
+
+from fabric.api import env
+
+import fablib
+from tests import FablibTestCase
+
+NODES = ['celery@images.demo.worker1', 'celery@images.demo.worker2']
+
+
+class ScaleCeleryQueueTest(FablibTestCase):
+    def setUp(self):
+        super(ScaleCeleryQueueTest, self).setUp()
+        env.celery_tasks_per_worker = 10
+        env.celery_autoscale_cooldown = 300
+        self.commands = []
+        self.logged = []
+        self.patch('_celery_control', lambda command, nodes, run_locally:
+                   self.commands.append(command) or len(nodes))
+        self.patch('_log_scaling', self.logged.append)
+
+    def scale(self, length, current, changed=0):
+        return fablib._scale_celery_queue(
+            'images', length, (4, 1, 16), (current, changed), NODES, False)
+
+    def test_short_queue(self):
+        self.assertEqual(self.scale(20, 4), (4, 0))
+        self.assertEqual(self.commands, [])
+        self.assertEqual(self.logged, [])
+
+    def test_scale_up(self):
+        current, changed = self.scale(150, 4)
+        self.assertEqual(current, 8)
+        self.assertTrue(changed > 0)
+        self.assertEqual(self.commands, ['autoscale 8 1'])
+        self.assertEqual(len(self.logged), 1)
+
+    def test_limit(self):
+        self.assertEqual(self.scale(1000, 4)[0], 16)
+
+    def test_resends_raised_max(self):
+        self.assertEqual(self.scale(150, 8, 12), (8, 12))
+        self.assertEqual(self.commands, ['autoscale 8 1'])
+        self.assertEqual(self.logged, [])
+
+    def test_cooldown(self):
+        changed = time.time()
+        self.assertEqual(self.scale(0, 8, changed), (8, changed))
+        self.assertEqual(self.commands, ['autoscale 8 1'])
+
+    def test_scale_down(self):
+        self.assertEqual(self.scale(0, 8)[0], 4)
+        self.assertEqual(self.commands, ['autoscale 4 1'])
+
+
+class CeleryScalingStateTest(FablibTestCase):
+    def setUp(self):
+        super(CeleryScalingStateTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        env.project_name = 'demo'
+        env.celery_autoscale_state = os.path.join(
+            self.directory, 'logs', '%(project_name)s-autoscale.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(CeleryScalingStateTest, self).tearDown()
+
+    def test_new_queues(self):
+        self.assertEqual(fablib._load_celery_scaling(
+            {None: (2, 1, 16), 'images': (4, 1, 16)}),
+            {None: (2, 0), 'images': (4, 0)})
+
+    def test_saved(self):
+        fablib._save_celery_scaling({None: (3, 10.5), 'images': (12, 20.5)})
+        self.assertTrue(os.path.exists(os.path.join(
+            self.directory, 'logs', 'demo-autoscale.json')))
+        self.assertEqual(fablib._load_celery_scaling(
+            {None: (2, 1, 16), 'images': (4, 1, 16)}),
+            {None: (3, 10.5), 'images': (12, 20.5)})
+
+    def test_limits_changed(self):
+        fablib._save_celery_scaling({None: (3, 10.5), 'images': (12, 20.5)})
+        self.assertEqual(fablib._load_celery_scaling(
+            {None: (4, 1, 16), 'images': (4, 1, 8)}),
+            {None: (4, 10.5), 'images': (8, 20.5)})
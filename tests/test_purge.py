@@ -0,0 +1,29 @@
+import re
+
+import fablib
+from tests import FablibTestCase
+
+
+class PurgeTargetsTest(FablibTestCase):
+    def test_paths(self):
+        self.assertEqual(
+            fablib._purge_targets(['/story/junk', 'story/junk', ' ', '']),
+            (['/story/junk'], []))
+
+    def test_query_strings_are_paths(self):
+        self.assertEqual(
+            fablib._purge_targets(['/search?q=junk&page=2']),
+            (['/search?q=junk&page=2'], []))
+
+    def test_globs(self):
+        paths, bans = fablib._purge_targets(['news/*.html?page=*'])
+        self.assertEqual(paths, [])
+        self.assertEqual(bans, [r'^/news/.*\.html\?page=.*$'])
+        self.assertTrue(re.match(bans[0], '/news/a/b.html?page=3'))
+        self.assertFalse(re.match(bans[0], '/news/a/bxhtml?page=3'))
+        self.assertFalse(re.match(bans[0], '/news/a/b.htmlxpage=3'))
+
+    def test_regular_expressions(self):
+        self.assertEqual(
+            fablib._purge_targets(['~^/story/(a|b)', '~^/story/(a|b)']),
+            ([], ['^/story/(a|b)']))
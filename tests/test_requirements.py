@@ -0,0 +1,37 @@
+from fabric.api import env
+
+import fablib
+from tests import FablibTestCase
+
+DIGEST = 'a' * 40
+FREEZE = 'b' * 40
+
+
+class RequirementsInstalledTest(FablibTestCase):
+    def setUp(self):
+        super(RequirementsInstalledTest, self).setUp()
+        env.env_path = '/home/newsapps/.virtualenvs/demo'
+
+    def test_unchanged(self):
+        commands = self.patch_run('%s %s\n%s  -' % (DIGEST, FREEZE, FREEZE))
+        self.assertTrue(fablib._requirements_installed(DIGEST))
+        self.assertIn('/home/newsapps/.virtualenvs/demo/.requirements.sha1',
+                      commands[0])
+
+    def test_requirements_changed(self):
+        self.patch_run('%s %s\n%s  -' % ('c' * 40, FREEZE, FREEZE))
+        self.assertFalse(fablib._requirements_installed(DIGEST))
+
+    def test_packages_changed(self):
+        self.patch_run('%s %s\n%s  -' % (DIGEST, FREEZE, 'c' * 40))
+        self.assertFalse(fablib._requirements_installed(DIGEST))
+
+    def test_old_stamp(self):
+        # Stamps from before the freeze hash was recorded have only the
+        # digest in them
+        self.patch_run('%s\n%s  -' % (DIGEST, FREEZE))
+        self.assertFalse(fablib._requirements_installed(DIGEST))
+
+    def test_no_stamp(self):
+        self.patch_run('', failed=True)
+        self.assertFalse(fablib._requirements_installed(DIGEST))
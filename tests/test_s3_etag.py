@@ -0,0 +1,38 @@
+import base64
+import hashlib
+from StringIO import StringIO
+
+from fabric.api import env
+
+import fablib
+from tests import FablibTestCase
+
+
+class S3EtagTest(FablibTestCase):
+    def setUp(self):
+        super(S3EtagTest, self).setUp()
+        env.s3_multipart_threshold = 10
+        env.s3_multipart_chunk_size = 4
+
+    def test_single_part(self):
+        body = StringIO('123456789')
+        md5 = hashlib.md5('123456789')
+        self.assertEqual(fablib._s3_etag(body), (
+            md5.hexdigest(),
+            (md5.hexdigest(), base64.b64encode(md5.digest()))))
+        self.assertEqual(body.tell(), 0)
+
+    def test_multipart(self):
+        body = StringIO('0123456789')
+        parts = ''.join(hashlib.md5(part).digest()
+                        for part in ('0123', '4567', '89'))
+        self.assertEqual(fablib._s3_etag(body), (
+            '%s-3' % hashlib.md5(parts).hexdigest(), None))
+        self.assertEqual(body.tell(), 0)
+
+    def test_exact_chunks(self):
+        env.s3_multipart_chunk_size = 5
+        parts = ''.join(hashlib.md5(part).digest()
+                        for part in ('01234', '56789'))
+        self.assertEqual(fablib._s3_etag(StringIO('0123456789'))[0],
+                         '%s-2' % hashlib.md5(parts).hexdigest())
@@ -0,0 +1,119 @@
+import json
+
+from fabric.api import env
+
+import fablib
+from tests import FablibTestCase
+
+
+class S3KeyReleaseTest(FablibTestCase):
+    def setUp(self):
+        super(S3KeyReleaseTest, self).setUp()
+        env.project_name = 'demo'
+
+    def test_release_prefix(self):
+        self.assertEqual(fablib._s3_key_release(
+            'demo/releases/abc123/js/app.js', ['abc123', 'def456']), 'abc123')
+        self.assertEqual(fablib._s3_key_release(
+            'demo/releases/0a0a0a/js/app.js', ['abc123']), None)
+
+    def test_fingerprint(self):
+        self.assertEqual(fablib._s3_key_release(
+            'demo/site_media/js/app.abc123.js', ['abc123']), 'abc123')
+        self.assertEqual(fablib._s3_key_release(
+            'demo/site_media/js/app.abc123.js.br', ['abc123']), 'abc123')
+        self.assertEqual(fablib._s3_key_release(
+            'demo/site_media/css/site.abc123.min.css', ['abc123']), 'abc123')
+
+    def test_not_a_release(self):
+        self.assertEqual(fablib._s3_key_release(
+            'demo/site_media/js/app.js', [None, 'abc123']), None)
+        self.assertEqual(fablib._s3_key_release(
+            'demo/site_media/js/abc123.js', ['abc123']), None)
+        self.assertEqual(fablib._s3_key_release(
+            'demo/site_media/abc123/app.js', ['abc123']), None)
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name=None):
+        self.bucket = bucket
+        self.key = self.name = name
+
+    def get_contents_as_string(self):
+        return self.bucket.keys[self.name]
+
+    def set_contents_from_string(self, body):
+        self.bucket.keys[self.key] = body
+
+
+class FakeBucket(object):
+    def __init__(self, names):
+        self.keys = dict((name, '') for name in names)
+
+    def list(self, prefix=''):
+        return [FakeKey(self, name) for name in sorted(self.keys)
+                if name.startswith(prefix)]
+
+    def get_key(self, name):
+        if name in self.keys:
+            return FakeKey(self, name)
+
+
+class FakeKeyModule(object):
+    Key = FakeKey
+
+
+class PruneS3ReleasesTest(FablibTestCase):
+    def setUp(self):
+        super(PruneS3ReleasesTest, self).setUp()
+        env.project_name = 'demo'
+        env.s3_releases_keep = 2
+        self.bucket = FakeBucket([])
+        self.deleted = []
+        self.patch('_s3_bucket', lambda name: self.bucket)
+        self.patch('_lazy_import', lambda name, required=True: FakeKeyModule)
+        self.patch('_delete_s3_keys',
+                   lambda bucket, names: self.deleted.extend(names) or [])
+
+    def prune(self, release, releases=None, names=()):
+        self.bucket.keys.update((name, '') for name in names)
+        if releases is not None:
+            self.bucket.keys['demo/releases.json'] = json.dumps(releases)
+        fablib._prune_s3_releases('media.example.com', release)
+        return json.loads(self.bucket.keys['demo/releases.json'])
+
+    def test_release_prefixes(self):
+        self.assertEqual(self.prune('ccc333', ['aaa111', 'bbb222'], [
+            'demo/releases/aaa111/js/app.js',
+            'demo/releases/bbb222/js/app.js',
+            'demo/releases/ccc333/js/app.js',
+        ]), ['bbb222', 'ccc333'])
+        self.assertEqual(self.deleted, ['demo/releases/aaa111/js/app.js'])
+
+    def test_fingerprints(self):
+        self.assertEqual(self.prune('ccc333', ['aaa111', 'bbb222'], [
+            'demo/site_media/js/app.aaa111.js',
+            'demo/site_media/js/app.aaa111.js.br',
+            'demo/site_media/js/app.bbb222.js',
+            'demo/site_media/js/app.ccc333.js',
+        ]), ['bbb222', 'ccc333'])
+        self.assertEqual(sorted(self.deleted), [
+            'demo/site_media/js/app.aaa111.js',
+            'demo/site_media/js/app.aaa111.js.br'])
+
+    def test_first_releases(self):
+        # The keys from before there were releases count as release null,
+        # and go once that's older than the ones kept
+        names = ['demo/site_media/js/app.js',
+                 'demo/site_media/js/app.aaa111.js']
+        self.assertEqual(self.prune('aaa111', names=names), [None, 'aaa111'])
+        self.assertEqual(self.deleted, [])
+        self.assertEqual(self.prune(
+            'bbb222', names=['demo/site_media/js/app.bbb222.js']),
+            ['aaa111', 'bbb222'])
+        self.assertEqual(self.deleted, ['demo/site_media/js/app.js'])
+
+    def test_redeploy(self):
+        self.assertEqual(self.prune('aaa111', ['aaa111', 'bbb222']),
+                         ['bbb222', 'aaa111'])
+        self.assertEqual(self.deleted, [])
@@ -0,0 +1,20 @@
+import fablib
+from tests import FablibTestCase
+
+
+class CountRsyncChangesTest(FablibTestCase):
+    def test_counts(self):
+        changes = '\n'.join([
+            '>f+++++++++ js/new.js',
+            '>fcs.t...... css/site.css',
+            '<f.st...... img/logo.png',
+            'cf......... fonts/link.woff',
+            '.f..t...... js/same.js',
+            'cd+++++++++ fonts/',
+            '.d..t...... img/',
+            '*deleting   js/old.js',
+        ])
+        self.assertEqual(fablib._count_rsync_changes(changes), (4, 1))
+
+    def test_nothing_changed(self):
+        self.assertEqual(fablib._count_rsync_changes(''), (0, 0))